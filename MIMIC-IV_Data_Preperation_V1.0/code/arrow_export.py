@@ -0,0 +1,229 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from settings import RESULT_ROOT_DIR, TUPLE_DIR, STRING_TUPLE_DIR, TIME_ENCODING, TIME_UNIT
+import tuple_codec
+import columnar_store
+import generate_tuples
+import stream_io
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+'''
+Export of tuples as Apache Arrow IPC files (Feather v2), which can be
+memory-mapped and read without copying or parsing text.
+
+Columns of a record batch:
+    patient_id      int64
+    admission_id    int64, -1 if empty
+    time            int64, seconds since 1970-01-01 (INT64_MIN if NaT), or the time offset
+                    if the tuples have relative time (see columnar_store.encode_time)
+    code            dictionary<int32, string>: the indices are the indexes in code_dict.csv
+                    and the dictionary holds the code tokens (e.g. "mimic_50912")
+    value           float32 value or sentinel code (see tuple_codec)
+    value_text      string, the values which are not restored by float32 (null otherwise)
+In string_tuples.arrow, value is dictionary<int32, string> over the string value vocabulary
+(the indices are the value IDs) and there is no value_text.
+
+Example:
+    for batch in iter_record_batches(RESULT_ROOT_DIR + 'tuples.arrow'):
+        arrays = batch_arrays(batch)      # numpy views of the mapped file
+        codes = torch.from_numpy(arrays['code'])
+'''
+
+
+def export_arrow(tuple_path, dict_path, out_path, vocab_path=None, chunksize=5000000, compression=None):
+    '''
+    Convert tuples.csv (or string_tuples.csv) to an Arrow IPC file.
+
+    Parameters:
+    ----
+        tuple_path:
+            filepath of tuples.csv
+        dict_path:
+            filepath of code_dict.csv
+        out_path:
+            filepath of the Arrow file
+        vocab_path:
+            filepath of string_value_vocab.csv if the tuples are string tuples
+        chunksize:
+            number of tuples of a record batch
+        compression:
+            None (the file can be mapped without copying), 'lz4' or 'zstd'
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('Exporting {} to {}'.format(tuple_path, out_path))
+
+    converter = _BatchConverter(dict_path, vocab_path, TIME_ENCODING is not None)
+    n_rows = 0
+    with _open_writer(out_path, converter.schema, compression) as writer, stream_io.open_reader(tuple_path) as f, \
+            pd.read_csv(f, index_col=False, chunksize=chunksize, dtype='str', keep_default_na=False,
+                        quoting=3) as reader:
+        for chunk in tqdm(reader):
+            writer.write_batch(converter.convert(chunk))
+            n_rows += chunk.shape[0]
+
+    print('rows:', n_rows)
+
+
+def export_tri_dir(src_dir, dict_path, out_dir, vocab_path=None, chunksize=5000000, compression=None):
+    '''
+    Convert the per-table tuple files (.tri) of a directory to Arrow IPC files (<name>.arrow),
+    with the same columns as export_arrow.
+    '''
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    for name in sorted(os.listdir(src_dir)):
+        if not stream_io.strip_ext(name).endswith('.tri'):
+            continue
+
+        out_path = out_dir + stream_io.strip_ext(name)[:-len('.tri')] + '.arrow'
+        print('Exporting {} to {}'.format(src_dir + name, out_path))
+
+        with stream_io.open_reader(src_dir + name, text=True) as f:
+            flags = generate_tuples._read_tri_header(f)
+            converter = _BatchConverter(dict_path, vocab_path, 'time' in flags)
+
+            with _open_writer(out_path, converter.schema, compression) as writer:
+                rows = []
+                for patient, data in generate_tuples._read_patient_blocks(f):
+                    rows.extend([patient] + line for line in data)
+                    if len(rows) >= chunksize:
+                        writer.write_batch(converter.convert(_tri_table(rows)))
+                        rows = []
+                if len(rows) != 0:
+                    writer.write_batch(converter.convert(_tri_table(rows)))
+
+
+def _tri_table(rows):
+    return pd.DataFrame(rows, columns=['patient_id', 'admission_id', 'time', 'code', 'value'], dtype=str)
+
+
+def _open_writer(out_path, schema, compression=None):
+    assert pa is not None, 'the Arrow export needs the pyarrow package'
+
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    return pa.ipc.new_file(out_path, schema, options=options)
+
+
+class _BatchConverter:
+    '''
+    Conversion of tables of tuples (str columns) to record batches.
+    The dictionaries of code and string values are fixed, so that all batches share them.
+    '''
+
+    def __init__(self, dict_path, vocab_path=None, relative=False):
+        assert pa is not None, 'the Arrow export needs the pyarrow package'
+
+        self.code2idx = tuple_codec.load_code_index(dict_path)
+        tokens = np.full(int(self.code2idx.max()) + 1, '', dtype=object)
+        tokens[self.code2idx.values] = self.code2idx.index.values
+        self.codes = pa.array(tokens, type=pa.string())
+
+        self.vocab = None
+        if vocab_path is not None:
+            vocab = tuple_codec.load_value_vocab(vocab_path)
+            texts = np.full(int(vocab.index.max()) + 1 if vocab.shape[0] else 0, '', dtype=object)
+            texts[vocab.index.values] = vocab.values
+            self.vocab = pa.array(texts, type=pa.string())
+
+        self.relative = relative
+
+        fields = [pa.field('patient_id', pa.int64()),
+                  pa.field('admission_id', pa.int64()),
+                  pa.field('time', pa.int64()),
+                  pa.field('code', pa.dictionary(pa.int32(), pa.string()))]
+        if self.vocab is None:
+            fields += [pa.field('value', pa.float32()), pa.field('value_text', pa.string())]
+        else:
+            fields += [pa.field('value', pa.dictionary(pa.int32(), pa.string()))]
+
+        metadata = {'time_encoding': json.dumps(TIME_ENCODING if relative else None), 'time_unit': str(TIME_UNIT)}
+        self.schema = pa.schema(fields, metadata=metadata)
+
+    def convert(self, table):
+        columns = [pa.array(table['patient_id'].values.astype(np.int64)),
+                   pa.array(table['admission_id'].replace('', '-1').values.astype(np.int64)),
+                   pa.array(columnar_store.encode_time(table['time'], self.relative)),
+                   pa.DictionaryArray.from_arrays(pa.array(table['code'].map(self.code2idx).values.astype(np.int32)),
+                                                  self.codes)]
+
+        if self.vocab is None:
+            value, value_text = tuple_codec.encode_values(table['value'])
+            value_text = np.where(value_text == '', None, value_text.astype(object))
+            columns += [pa.array(value), pa.array(value_text, type=pa.string())]
+        else:
+            columns += [pa.DictionaryArray.from_arrays(pa.array(table['value'].values.astype(np.int32)), self.vocab)]
+
+        return pa.RecordBatch.from_arrays(columns, schema=self.schema)
+
+
+def iter_record_batches(arrow_path):
+    '''
+    Iterate over the record batches of an Arrow IPC file.
+    The file is memory-mapped, so (without compression) the batches are views of the file.
+    '''
+
+    assert pa is not None, 'reading Arrow files needs the pyarrow package'
+
+    reader = pa.ipc.open_file(pa.memory_map(arrow_path, 'r'))
+    for i in range(reader.num_record_batches):
+        yield reader.get_batch(i)
+
+
+def batch_arrays(batch):
+    '''
+    numpy arrays of the columns of a record batch, without copying
+    (dictionary columns are returned as their int32 indices; value_text is copied)
+    '''
+
+    arrays = {}
+    for name, column in zip(batch.schema.names, batch.columns):
+        if pa.types.is_dictionary(column.type):
+            column = column.indices
+        if name == 'value_text':
+            arrays[name] = column.to_numpy(zero_copy_only=False)
+        else:
+            arrays[name] = column.to_numpy()
+    return arrays
+
+
+def export_results(tri=False):
+    '''
+    Export tuples.csv and string_tuples.csv (and the .tri files of all tables if tri is True)
+    as Arrow files under RESULT_ROOT_DIR
+    '''
+
+    dict_path = RESULT_ROOT_DIR + 'code_dict.csv'
+    export_arrow(RESULT_ROOT_DIR + 'tuples.csv', dict_path, RESULT_ROOT_DIR + 'tuples.arrow')
+    export_arrow(RESULT_ROOT_DIR + 'string_tuples.csv', dict_path, RESULT_ROOT_DIR + 'string_tuples.arrow',
+                 vocab_path=generate_tuples.VALUE_VOCAB_PATH)
+
+    if tri:
+        export_tri_dir(TUPLE_DIR, dict_path, RESULT_ROOT_DIR + 'arrow/tuple/')
+        export_tri_dir(STRING_TUPLE_DIR, dict_path, RESULT_ROOT_DIR + 'arrow/string_tuple/',
+                       vocab_path=generate_tuples.VALUE_VOCAB_PATH)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export tuples as Arrow IPC files.')
+    parser.add_argument('--tri', action='store_true', help='also export the per-table tuple files (.tri)')
+    args = parser.parse_args()
+
+    export_results(args.tri)
+
+
+if __name__=='__main__':
+    main()
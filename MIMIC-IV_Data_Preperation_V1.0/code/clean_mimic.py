@@ -6,6 +6,8 @@ import settings
 import generate_dictionary
 import generate_tuples
 import post_process
+import cohort
+import value_norm
 
 
 def main():
@@ -13,8 +15,24 @@ def main():
     parser = argparse.ArgumentParser(description='Whether add label or column, default false.')
     parser.add_argument('--add_label', action='store_true', help ='add labels for the dictionary (need extra data)')
     parser.add_argument('--add_category', action='store_true', help='add categories for the dictionary (need extra data)')    
+    parser.add_argument('--int_tuples', action='store_true', help='also output tuples_int.csv with integer codes and float32 values')
+    parser.add_argument('--postings', action='store_true', help='also output the code-to-patient postings of tuples.csv')
+    parser.add_argument('--columnar', action='store_true', help='also output tuples as a binary columnar store')
+    parser.add_argument('--sqlite', action='store_true', help='also export the results to an indexed SQLite file (mimic.sqlite)')
+    parser.add_argument('--arrow', action='store_true', help='also export tuples as Arrow IPC files (needs pyarrow)')
+    parser.add_argument('--arrow_tri', action='store_true', help='with --arrow, also export the tuple files of each table')
+    parser.add_argument('--normalize', choices=value_norm.MODES, default=None, help='also output tuples with normalized values (z-scores or quantile bins)')
+    parser.add_argument('--n_bins', type=int, default=10, help='number of quantile bins of --normalize bins')
+    parser.add_argument('--cohort', default=None, help='file of subject_ids (one per line), only clean the data of these subjects')
+    parser.add_argument('--code_dict', default=None, help='reuse index/code_dict.csv of another run (e.g. the full population) instead of generating it')
+    parser.add_argument('--n_jobs', type=int, default=os.cpu_count(), help='number of processes used to merge tuples')
     args = parser.parse_args()
 
+    if args.cohort is not None:
+        assert os.path.exists(args.cohort)
+        settings.COHORT = args.cohort
+        os.environ['MIMIC_COHORT'] = args.cohort
+    
     # assert paths
     assert os.path.exists(settings.MIMIC_DIR)
     assert os.path.exists(settings.ROLL_UP_SRC)
@@ -35,8 +53,11 @@ def main():
         os.mkdir(settings.IDX_DIR)
     
     # clean MIMIC data
-    generate_dictionary.main()
-    generate_tuples.main()
+    if args.code_dict is not None:
+        cohort.reuse_code_dict(args.code_dict)
+    else:
+        generate_dictionary.main()
+    generate_tuples.main(args.n_jobs)
     post_process.main(args)
     
     
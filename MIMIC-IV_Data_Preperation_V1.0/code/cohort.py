@@ -0,0 +1,136 @@
+import sys
+import os
+import shutil
+import functools
+import pandas as pd
+import settings
+import stream_io
+
+
+'''
+Cohort-restricted runs: if COHORT is set (see settings.py, or --cohort of
+clean_mimic.py), the raw tables are filtered by subject_id when they are
+read, so only the tuples of the cohort are generated.
+
+The dates of the raw tables are parsed after filtering, which saves most of
+the parsing time of the large tables (chartevents, labevents) for a small
+cohort.
+
+Example:
+    python clean_mimic.py --cohort subjects.txt --code_dict Full_Cleaned_MIMIC-IV/index/code_dict.csv
+'''
+
+
+def load_cohort(path=None):
+    '''
+    The subject_ids of the cohort, as a set of str (None if no cohort is set)
+
+    Parameters:
+    ----
+        path:
+            file of subject_ids, one per line (default: COHORT of settings.py)
+    '''
+
+    if path is None:
+        path = settings.COHORT
+    if path is None:
+        return None
+    return _read_cohort(os.path.abspath(path))
+
+
+@functools.lru_cache(maxsize=None)
+def _read_cohort(path):
+    with open(path, 'r', encoding='utf8') as f:
+        subjects = set(i.strip() for i in f)
+    subjects.discard('')
+    subjects.discard('subject_id')
+    print('cohort: {} subjects from {}'.format(len(subjects), path))
+    return frozenset(subjects)
+
+
+def read_csv(path, **kwargs):
+    '''
+    pandas.read_csv of a raw table, restricted to the subjects of the cohort.
+    Without cohort, or if the table has no subject_id column, it is the same as pandas.read_csv.
+
+    The arguments usecols, index_col, parse_dates and chunksize are supported as in pandas.read_csv;
+    subject_id is read for filtering even if it is not in usecols.
+    '''
+
+    subjects = load_cohort()
+    if subjects is None or 'subject_id' not in pd.read_csv(path, nrows=0).columns:
+        return pd.read_csv(path, **kwargs)
+
+    usecols = kwargs.pop('usecols', None)
+    drop_subject = False
+    if usecols is not None:
+        usecols = list(usecols)
+        if 'subject_id' not in usecols:
+            usecols.append('subject_id')
+            drop_subject = True
+        kwargs['usecols'] = usecols
+
+    index_col = kwargs.pop('index_col', None)
+    parse_dates = kwargs.pop('parse_dates', None) or []
+    date_format = kwargs.pop('date_format', None)
+    kwargs.pop('infer_datetime_format', None)
+
+    def select(table):
+        table = table.loc[table['subject_id'].astype(str).isin(subjects), :].reset_index(drop=True)
+        for col in parse_dates:
+            table = table.assign(**{col:pd.to_datetime(table[col], format=date_format)})
+        if drop_subject:
+            table = table.drop(columns='subject_id')
+        if index_col is not None and index_col is not False:
+            table = table.set_index(index_col)
+        return table
+
+    reader = pd.read_csv(path, index_col=False, **kwargs)
+    if kwargs.get('chunksize') is None:
+        return select(reader)
+    return _CohortReader(reader, select)
+
+
+class _CohortReader:
+    '''
+    A chunked reader whose chunks are filtered by the cohort
+    '''
+
+    def __init__(self, reader, select):
+        self.reader = reader
+        self.select = select
+
+    def __iter__(self):
+        for chunk in self.reader:
+            yield self.select(chunk)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reader.close()
+
+
+def reuse_code_dict(dict_path):
+    '''
+    Use the dictionary of another run (e.g. of the full population) instead of generating one,
+    so that the code indexes are the same.
+
+    Parameters:
+    ----
+        dict_path:
+            filepath of the code_dict.csv under the index directory of the other run
+            (the code_dict.npy next to it is copied as well)
+
+    Returns:
+    ----
+        No return
+    '''
+
+    dict_path = stream_io.resolve(dict_path)
+    npy_path = os.path.join(os.path.dirname(dict_path), 'code_dict.npy')
+    assert os.path.exists(npy_path), '{} not found'.format(npy_path)
+
+    print('Reusing the dictionary', dict_path)
+    shutil.copyfile(dict_path, settings.IDX_DIR + os.path.basename(dict_path))
+    shutil.copyfile(npy_path, settings.IDX_DIR + 'code_dict.npy')
@@ -0,0 +1,300 @@
+import sys
+import os
+import json
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from settings import RESULT_ROOT_DIR, TIME_ENCODING, TIME_UNIT
+import tuple_codec
+import stream_io
+
+
+'''
+Binary columnar store of tuples.
+
+Each column is a fixed-width binary file which can be memory-mapped with numpy:
+    patient.bin      int32   patient ID
+    admission.bin    int32   admission ID (-1 if empty)
+    time.bin         int64   seconds since 1970-01-01 (INT64_MIN if NaT),
+                             or the time offset if the tuples have relative time (see TIME_ENCODING in settings.py)
+    code.bin         int32   index in code_dict.csv
+    value.bin        float32 value or sentinel code (see tuple_codec)
+    text_offset.bin  int64   offset of the text value in heap.bin (-1 if none)
+    text_length.bin  int32   length (bytes) of the text value
+Text values (string values and numbers whose text is not restored from float32) are stored in heap.bin (utf8).
+In a store of string_tuples.csv (value_ids=True), value.bin holds the int32 value IDs of the
+string value vocabulary instead (see tuple_codec.load_value_vocab) and there is no text value.
+patients.npy holds the first row and the number of rows of each patient.
+'''
+
+
+COLUMNS = {
+    'patient': np.int32,
+    'admission': np.int32,
+    'time': np.int64,
+    'code': np.int32,
+    'value': np.float32,
+    'text_offset': np.int64,
+    'text_length': np.int32,
+}
+
+def build_store(tuple_path, dict_path, store_dir, chunksize=10000000, value_ids=False):
+    '''
+    Convert tuples.csv (or string_tuples.csv) to a binary columnar store.
+
+    Parameters:
+    ----
+        tuple_path:
+            filepath of tuples.csv
+        dict_path:
+            filepath of code_dict.csv
+        store_dir:
+            directory to output the store
+        value_ids:
+            whether the values are value IDs (string_tuples.csv), stored as int32
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('Building columnar store of {} in {}'.format(tuple_path, store_dir))
+
+    if not os.path.exists(store_dir):
+        os.mkdir(store_dir)
+
+    code2idx = tuple_codec.load_code_index(dict_path)
+    dtypes = dict(COLUMNS, value=np.int32) if value_ids else COLUMNS
+
+    files = {k:open(store_dir + k + '.bin', 'wb') for k in dtypes}
+    heap = open(store_dir + 'heap.bin', 'wb')
+    heap_size = 0
+    n_rows = 0
+    n_time_error = 0
+
+    with stream_io.open_reader(tuple_path) as f, pd.read_csv(f, index_col=False, chunksize=chunksize,
+            dtype='str', keep_default_na=False, quoting=3) as reader:
+        for chunk in tqdm(reader):
+            columns = {}
+            columns['patient'] = chunk['patient_id'].astype(np.int32).values
+            columns['admission'] = chunk['admission_id'].replace('', '-1').astype(np.int32).values
+            columns['time'] = encode_time(chunk['time'], TIME_ENCODING is not None)
+            code = chunk['code'].map(code2idx)
+            if code.isna().any():
+                raise ValueError('codes not in {}: {}'.format(dict_path, chunk.loc[code.isna(), 'code'].unique().tolist()))
+            columns['code'] = code.values.astype(np.int32)
+            if value_ids:
+                columns['value'] = chunk['value'].astype(np.int32).values
+                value_text = np.full(chunk.shape[0], '', dtype=object)
+            else:
+                columns['value'], value_text = tuple_codec.encode_values(chunk['value'])
+
+            # the time must be restored exactly
+            n_time_error += int((decode_time(columns['time'], TIME_ENCODING is not None) != chunk['time'].values).sum())
+
+            # put text values in the heap
+            has_text = value_text != ''
+            encoded = [t.encode('utf8') for t in value_text[has_text]]
+            lengths = np.array([len(t) for t in encoded], dtype=np.int64)
+
+            columns['text_offset'] = np.full(chunk.shape[0], -1, dtype=np.int64)
+            columns['text_length'] = np.zeros(chunk.shape[0], dtype=np.int32)
+            columns['text_offset'][has_text] = heap_size + np.cumsum(lengths) - lengths
+            columns['text_length'][has_text] = lengths
+            heap.write(b''.join(encoded))
+            heap_size += int(lengths.sum())
+
+            for k, dtype in dtypes.items():
+                files[k].write(np.ascontiguousarray(columns[k], dtype=dtype).tobytes())
+            n_rows += chunk.shape[0]
+
+    for f in files.values():
+        f.close()
+    heap.close()
+
+    if n_time_error != 0:
+        print('Warning: {} times cannot be restored exactly'.format(n_time_error))
+
+    with open(store_dir + 'meta.json', 'w', encoding='utf8') as f:
+        json.dump({'rows': n_rows, 'heap_size': heap_size,
+                   'columns': {k:np.dtype(v).str for k, v in dtypes.items()},
+                   'time_encoding': TIME_ENCODING, 'time_unit': TIME_UNIT}, f, indent=4)
+
+    # offsets of patients
+    patient = np.memmap(store_dir + 'patient.bin', dtype=np.int32, mode='r', shape=(n_rows,))
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(patient)) + 1)) if n_rows else np.zeros(0, np.int64)
+    patients = np.zeros(starts.shape[0], dtype=[('patient_id', np.int32), ('start', np.int64), ('count', np.int64)])
+    patients['patient_id'] = patient[starts]
+    patients['start'] = starts
+    patients['count'] = np.diff(np.append(starts, n_rows))
+    np.save(store_dir + 'patients.npy', patients)
+
+    print('rows:', n_rows, 'patients:', patients.shape[0], 'heap size:', heap_size)
+
+
+def encode_time(time:pd.Series, relative=False):
+    '''
+    Convert time strings to int64 seconds since 1970-01-01 (NaT -> INT64_MIN),
+    or time offsets to int64 if relative is True (empty -> INT64_MIN)
+    '''
+
+    if relative:
+        time = pd.to_numeric(time.replace('', np.nan), errors='coerce')
+        return time.fillna(np.iinfo(np.int64).min).values.astype(np.int64)
+
+    time = pd.to_datetime(time, format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    return time.values.astype('datetime64[s]').astype(np.int64)
+
+
+def decode_time(time, relative=False):
+    '''
+    Convert int64 seconds since 1970-01-01 (or time offsets if relative is True) back to time strings
+    '''
+
+    time = np.asarray(time, dtype=np.int64)
+    if relative:
+        return np.where(time == np.iinfo(np.int64).min, '', time.astype(str)).astype(object)
+
+    text = np.datetime_as_string(time.astype('datetime64[s]'), unit='s')
+    return np.where(text == 'NaT', 'NaT', np.char.replace(text, 'T', ' ')).astype(object)
+
+
+def load_store(store_dir):
+    '''
+    Memory-map all columns of a columnar store (no data is copied).
+
+    Parameters:
+    ----
+        store_dir:
+            directory of the store
+
+    Returns:
+    ----
+        A dictionary of numpy.memmap: the columns, "heap" and "patients"
+    '''
+
+    with open(store_dir + 'meta.json', 'r', encoding='utf8') as f:
+        meta = json.load(f)
+
+    store = {}
+    for k, dtype in meta['columns'].items():
+        if meta['rows'] == 0:
+            store[k] = np.zeros(0, dtype=dtype)
+        else:
+            store[k] = np.memmap(store_dir + k + '.bin', dtype=dtype, mode='r', shape=(meta['rows'],))
+
+    if meta['heap_size'] == 0:
+        store['heap'] = np.zeros(0, dtype=np.uint8)
+    else:
+        store['heap'] = np.memmap(store_dir + 'heap.bin', dtype=np.uint8, mode='r', shape=(meta['heap_size'],))
+    store['patients'] = np.load(store_dir + 'patients.npy', mmap_mode='r')
+    return store
+
+
+def patient_rows(store, patient_id):
+    '''
+    Get the rows of a patient as views of the memory-mapped columns.
+
+    Parameters:
+    ----
+        store:
+            the store returned by load_store
+        patient_id:
+            ID of the patient
+
+    Returns:
+    ----
+        A dictionary of columns (empty columns if the patient has no tuple)
+    '''
+
+    patients = store['patients']
+    i = np.searchsorted(patients['patient_id'], patient_id)
+    if i < patients.shape[0] and patients['patient_id'][i] == patient_id:
+        start, count = int(patients['start'][i]), int(patients['count'][i])
+    else:
+        start, count = 0, 0
+
+    return {k:store[k][start:start + count] for k in COLUMNS}
+
+
+def get_texts(store, rows):
+    '''
+    Get the text values of rows (empty string if a row has no text value).
+    '''
+
+    offset = np.asarray(rows['text_offset'])
+    length = np.asarray(rows['text_length'], dtype=np.int64)
+    texts = np.full(offset.shape[0], '', dtype=object)
+
+    has_text = offset >= 0
+    if not has_text.any():
+        return texts
+    offset, length = offset[has_text], length[has_text]
+
+    # gather the texts from the heap into one buffer, each followed by a newline
+    # (a value of tuples.csv has no newline), then decode and split the buffer at once
+    ends = np.cumsum(length + 1)
+    buffer = np.full(int(ends[-1]), ord('\n'), dtype=np.uint8)
+    is_text = np.ones(buffer.shape[0], dtype=bool)
+    is_text[ends - 1] = False
+    positions = np.flatnonzero(is_text)
+    buffer[positions] = store['heap'][positions + np.repeat(offset - (ends - length - 1), length)]
+
+    texts[has_text] = buffer.tobytes().decode('utf8').split('\n')[:-1]
+    return texts
+
+
+def store_to_csv(store_dir, dict_path, out_path, chunksize=10000000):
+    '''
+    Convert a columnar store back to the text form of tuples.csv.
+
+    Parameters:
+    ----
+        store_dir:
+            directory of the store
+        dict_path:
+            filepath of code_dict.csv
+        out_path:
+            filepath to output tuples.csv
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('Converting columnar store {} to {}'.format(store_dir, out_path))
+
+    store = load_store(store_dir)
+    with open(store_dir + 'meta.json', 'r', encoding='utf8') as f:
+        meta = json.load(f)
+    code2idx = tuple_codec.load_code_index(dict_path)
+    idx2code = pd.Series(code2idx.index, index=code2idx.values)
+    n_rows = store['patient'].shape[0]
+
+    with open(out_path, 'w', encoding='utf8') as f:
+        f.write(','.join(tuple_codec.cols) + '\n')
+
+        for start in tqdm(range(0, n_rows, chunksize)):
+            rows = {k:store[k][start:start + chunksize] for k in COLUMNS}
+
+            admission = rows['admission'].astype(str).astype(object)
+            admission[rows['admission'] == -1] = ''
+            code = idx2code.reindex(rows['code']).values
+            if np.issubdtype(rows['value'].dtype, np.integer):
+                value = rows['value'].astype(str).astype(object)
+            else:
+                value = tuple_codec.decode_values(rows['value'], get_texts(store, rows))
+
+            lines = rows['patient'].astype(str).astype(object) + ',' + admission + ',' + \
+                decode_time(rows['time'], meta.get('time_encoding') is not None) + ',' + code + ',' + value + '\n'
+            f.write(''.join(lines))
+
+
+def main():
+    build_store(RESULT_ROOT_DIR + 'tuples.csv', RESULT_ROOT_DIR + 'code_dict.csv', RESULT_ROOT_DIR + 'columnar/')
+    build_store(RESULT_ROOT_DIR + 'string_tuples.csv', RESULT_ROOT_DIR + 'code_dict.csv',
+                RESULT_ROOT_DIR + 'string_columnar/', value_ids=True)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,222 @@
+import sys
+import os
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from tqdm import tqdm
+from settings import RESULT_ROOT_DIR, TIME_ENCODING, TIME_UNIT
+import tuple_codec
+import tuple_index
+import stream_io
+
+
+'''
+Sparse patient x code x time-bin feature matrices built from tuples.csv.
+
+The matrix has a row per patient and a column per (time bin, code):
+column = bin * n_codes + index, where index is the index of the code in
+code_dict.csv and n_codes = max index + 1 (so bin 0 covers columns 0..n_codes-1).
+The time of a tuple is counted in hours from the first admission of the
+patient (in_time of patients_dict.csv), or from the reference time if the
+tuples have relative time (see TIME_ENCODING in settings.py).
+
+Aggregations of the tuples of a (patient, bin, code):
+    count:              number of tuples
+    last:               the last numeric value
+    mean, min, max:     of the numeric values
+
+Example (daily counts in the first week):
+    matrix, patient_ids, n_bins = build_feature_matrix(bin_hours=24, agg='count', window=(0, 168))
+    first_day = matrix[:, :n_codes]
+'''
+
+
+AGGREGATIONS = ['count', 'last', 'mean', 'min', 'max']
+
+
+def build_feature_matrix(tuple_path=RESULT_ROOT_DIR + 'tuples.csv', dict_path=RESULT_ROOT_DIR + 'code_dict.csv',
+                         bin_hours=24, agg='count', window=None, patients=None, n_jobs=1, batch_size=1000):
+    '''
+    Build a sparse feature matrix with one pass over the tuples.
+
+    Parameters:
+    ----
+        tuple_path:
+            filepath of tuples.csv, which must have its index (see tuple_index)
+        dict_path:
+            filepath of code_dict.csv, which gives the column of each code
+        bin_hours:
+            size of the time bins in hours
+        agg:
+            aggregation of the tuples in a bin, one of AGGREGATIONS
+        window:
+            (start, end) in hours from the first admission (default: (0, None)), end None for unbounded;
+            bin 0 starts at start. Tuples without time or outside the window are ignored.
+        patients:
+            IDs of the patients (default: all patients), the rows of the matrix are sorted by ID
+        n_jobs:
+            number of processes, each process builds the rows of a range of patients
+        batch_size:
+            number of patients read at a time by a process
+
+    Returns:
+    ----
+        matrix:
+            scipy.sparse.csr_matrix of shape (number of patients, n_bins * n_codes),
+            int32 for count, float32 for other aggregations
+        patient_ids:
+            int64 IDs of the patients of the rows
+        n_bins:
+            number of time bins
+    '''
+
+    assert agg in AGGREGATIONS, 'unknown aggregation {}'.format(agg)
+    start, end = window if window is not None else (0, None)
+
+    index = tuple_index.load_index(tuple_path)
+    selected = np.ones(index.shape[0], dtype=bool)
+    if patients is not None:
+        selected = np.isin(index['patient_id'], np.asarray(list(patients), dtype=np.int64))
+    patient_ids = np.asarray(index['patient_id'][selected])
+    counts = np.asarray(index['count'][selected])
+
+    references = _load_references(patient_ids)
+    n_codes = int(tuple_codec.load_code_index(dict_path).max()) + 1
+
+    # split the patients into ranges with a similar number of tuples
+    bounds = np.searchsorted(np.cumsum(counts), np.linspace(0, counts.sum(), n_jobs + 1)[1:-1])
+    bounds = np.unique(np.concatenate(([0], bounds, [patient_ids.shape[0]])))
+    tasks = [(tuple_path, dict_path, patient_ids[lo:hi], references[lo:hi], lo,
+              bin_hours, agg, start, end, batch_size) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+    if len(tasks) > 1:
+        with multiprocessing.Pool(min(n_jobs, len(tasks))) as pool:
+            parts = pool.map(_build_part, tasks)
+    else:
+        parts = [_build_part(task) for task in tasks]
+
+    rows, bins, codes, data = [np.concatenate([p[i] for p in parts]) if len(parts) else np.zeros(0) for i in range(4)]
+
+    if end is not None:
+        n_bins = int(np.ceil((end - start) / bin_hours))
+    else:
+        n_bins = int(bins.max()) + 1 if bins.shape[0] else 0
+
+    dtype = np.int32 if agg == 'count' else np.float32
+    matrix = scipy.sparse.coo_matrix((data.astype(dtype), (rows.astype(np.int64), bins.astype(np.int64) * n_codes + codes)),
+                                     shape=(patient_ids.shape[0], n_bins * n_codes)).tocsr()
+
+    print('feature matrix: {} patients, {} bins x {} codes, {} non-zeros'.format(
+        matrix.shape[0], n_bins, n_codes, matrix.nnz))
+    return matrix, patient_ids, n_bins
+
+
+def _load_references(patient_ids, patients_dict_path=RESULT_ROOT_DIR + 'patients_dict.csv'):
+    '''
+    The reference time of each patient in seconds (NaN if unknown), 0 with relative time
+    '''
+
+    if TIME_ENCODING is not None:
+        return np.zeros(patient_ids.shape[0])
+
+    patients = pd.read_csv(patients_dict_path, usecols=['subject_id', 'in_time'], dtype={'subject_id':np.int64},
+                           parse_dates=['in_time'], index_col='subject_id')
+    in_time = patients['in_time'].reindex(patient_ids)
+    return _seconds(in_time)
+
+
+def _seconds(times):
+    '''
+    Seconds since the epoch of a datetime Series, NaN for NaT
+    '''
+
+    seconds = times.values.astype('datetime64[s]').astype(np.int64).astype(np.float64)
+    seconds[times.isna().values] = np.nan
+    return seconds
+
+
+def _build_part(args):
+    '''
+    Aggregate the tuples of a range of patients.
+    Return the arrays (row, bin, code index, aggregated value).
+    '''
+
+    tuple_path, dict_path, patient_ids, references, row_offset, bin_hours, agg, start, end, batch_size = args
+
+    index = tuple_index.load_index(tuple_path)
+    code2idx = tuple_codec.load_code_index(dict_path)
+
+    parts = []
+    with stream_io.open_reader(tuple_path) as f:
+        for lo in tqdm(range(0, patient_ids.shape[0], batch_size), disable=row_offset != 0):
+            ids = patient_ids[lo:lo + batch_size]
+            table = tuple_index.read_patients(f, index, ids, keep_default_na=False)
+            if table.shape[0] == 0:
+                continue
+
+            rows = np.searchsorted(ids, table['patient_id'].values.astype(np.int64))
+            hours = _hours(table['time'], references[lo:lo + batch_size][rows])
+
+            batch = pd.DataFrame({'row': rows + lo + row_offset,
+                                  'bin': np.floor((hours - start) / bin_hours),
+                                  'code': table['code'].map(code2idx).values,
+                                  'value': pd.to_numeric(table['value'], errors='coerce').values})
+
+            keep = batch['bin'].notna() & batch['code'].notna() & (hours >= start)
+            if end is not None:
+                keep &= hours < end
+            if agg != 'count':
+                keep &= batch['value'].notna()
+            batch = batch.loc[keep, :]
+
+            # the tuples of a patient are ordered by time, so "last" is the latest value
+            grouped = batch.groupby(['row', 'bin', 'code'], sort=False)['value']
+            batch = (grouped.size() if agg == 'count' else grouped.agg(agg)).reset_index()
+            parts.append(batch.values)
+
+    if len(parts) == 0:
+        return [np.zeros(0, dtype=np.int64)] * 3 + [np.zeros(0)]
+
+    parts = np.concatenate(parts)
+    return parts[:, 0].astype(np.int64), parts[:, 1].astype(np.int64), parts[:, 2].astype(np.int64), parts[:, 3]
+
+
+def _hours(time, references):
+    '''
+    Hours from the reference time of each tuple, NaN if the tuple has no time
+    '''
+
+    if TIME_ENCODING is not None:
+        return pd.to_numeric(time, errors='coerce').values * (TIME_UNIT / 3600)
+
+    seconds = _seconds(pd.to_datetime(time, errors='coerce'))
+    return (seconds - references) / 3600
+
+
+def save_feature_matrix(matrix, patient_ids, out_path):
+    '''
+    Save a feature matrix (.npz) and the IDs of its rows (_patients.npy)
+    '''
+
+    scipy.sparse.save_npz(out_path, matrix)
+    np.save(os.path.splitext(out_path)[0] + '_patients.npy', patient_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a sparse patient x code x time-bin feature matrix.')
+    parser.add_argument('--bin_hours', type=float, default=24, help='size of the time bins in hours')
+    parser.add_argument('--agg', choices=AGGREGATIONS, default='count', help='aggregation of the tuples in a bin')
+    parser.add_argument('--window', type=float, nargs=2, default=None, metavar=('START', 'END'),
+                        help='time window in hours from the first admission')
+    parser.add_argument('--n_jobs', type=int, default=os.cpu_count(), help='number of processes')
+    args = parser.parse_args()
+
+    matrix, patient_ids, n_bins = build_feature_matrix(bin_hours=args.bin_hours, agg=args.agg,
+                                                       window=args.window, n_jobs=args.n_jobs)
+    save_feature_matrix(matrix, patient_ids, RESULT_ROOT_DIR + 'features_{}.npz'.format(args.agg))
+
+
+if __name__=='__main__':
+    main()
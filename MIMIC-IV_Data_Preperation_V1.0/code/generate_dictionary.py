@@ -4,8 +4,11 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import json
+import hashlib
 import rolluptool
-from settings import RESULT_ROOT_DIR, TUPLE_DIR, IDX_DIR, MIMIC_DIR, UOM_SRC
+import stream_io
+import cohort
+from settings import RESULT_ROOT_DIR, TUPLE_DIR, IDX_DIR, MIMIC_DIR, UOM_SRC, SHARD
 
 
 V_FREQ = 'value_frequency'
@@ -13,6 +16,9 @@ FREQ = 'total_frequency'
 
 idx_cols = ['code','code_type',V_FREQ,FREQ,'source_table','unit_of_measurement','with_value']
 
+# minimum frequency of a code in the dictionary
+MIN_FREQ = 1000
+
 
 def _output_dict(table:pd.DataFrame, tablename:str):
     '''
@@ -32,8 +38,33 @@ def _output_dict(table:pd.DataFrame, tablename:str):
     print('unknown freq', int(table.loc['<unk>', FREQ]) if '<unk>' in table.index else 0)
     if '<unk>' in table.index:
         table.drop(['<unk>'], inplace=True)
-        
-    table = table.loc[(table[FREQ] >= 1000)]
+    
+    # a shard keeps the counts of all codes, the frequency threshold is applied by reduce_shard_dicts
+    if SHARD is not None:
+        table.to_csv(IDX_DIR + tablename + '_dict.part', columns=[FREQ], index_label=['code', 'code_type'])
+        return
+    
+    _output_count_dict(table, tablename)
+
+
+def _output_count_dict(table:pd.DataFrame, tablename:str):
+    '''
+    Output the dictionary of a table without values, from the frequency of its codes.
+    Called by function _output_dict() and reduce_shard_dicts().
+    
+    Parameters:
+    ----
+        table:
+            The frequency (column total_frequency) of codes, indexed by (code, code_type)
+        tablename:
+            tablename of the output file
+            
+    Returns:
+    ----
+        No return
+    '''
+    
+    table = table.loc[(table[FREQ] >= MIN_FREQ)].copy()
     
     table.sort_values(FREQ, inplace=True)
     table[V_FREQ] = 0
@@ -66,7 +97,7 @@ def _procedures_icd_dict(tablename):
     path = MIMIC_DIR + 'hosp/' + tablename + '.csv'
     cols = ['subject_id', 'hadm_id', 'seq_num', 'chartdate', 'icd_code', 'icd_version']
     setting = {'icd_code': str, 'icd_version':int}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    table = cohort.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
     table.rename({'icd_code':'code', 'icd_version':'code_type'}, axis=1, inplace=True)
     print('number of code before rolling up:', 
           table[['code', 'code_type']].drop_duplicates(keep='first', inplace=False).shape[0])
@@ -93,7 +124,7 @@ def _hcpcsevents_dict(tablename):
     path = MIMIC_DIR + 'hosp/' + tablename + '.csv'
     cols = ['subject_id', 'hadm_id', 'chartdate', 'hcpcs_cd', 'seq_num', 'short_description']
     setting = {'hcpcs_cd': str}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    table = cohort.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
     table.rename({'hcpcs_cd':'code'}, axis=1, inplace=True)
     print('number of code before rolling up:', 
           table['code'].drop_duplicates(keep='first', inplace=False).shape[0])
@@ -147,7 +178,7 @@ def generate_drgcodes_dict(tablename):
     path = MIMIC_DIR + 'hosp/' + tablename + '.csv'
     cols = ['subject_id', 'hadm_id', 'drg_type', 'drg_code', 'description', 'drg_severity', 'drg_mortality']
     setting = {'drg_code': 'str'}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    table = cohort.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
     table.rename({'drg_code':'code'}, axis=1, inplace=True)
     print('number of code before rolling up:', 
           table['code'].drop_duplicates(keep='first', inplace=False).shape[0])
@@ -181,7 +212,7 @@ def generate_diagnoses_icd_dict(tablename):
     path = MIMIC_DIR + 'hosp/' + tablename + '.csv'
     cols = ['subject_id', 'hadm_id', 'seq_num', 'icd_code', 'icd_version']
     setting = {'icd_code': str, 'icd_version':str}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    table = cohort.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
     table.rename({'icd_code':'code', 'icd_version':'code_type'}, axis=1, inplace=True)
     print('number of code before rolling up:', 
           table[['code', 'code_type']].drop_duplicates(keep='first', inplace=False).shape[0])
@@ -230,7 +261,7 @@ def generate_prescriptions_dict(tablename):
     cols = ['subject_id', 'hadm_id', 'pharmacy_id', 'starttime', 'stoptime', 'drug_type', 'drug', 'gsn', 'ndc', 'prod_strength', 'form_rx', 'dose_val_rx', 'dose_unit_rx', 'form_val_disp', 'form_unit_disp', 'doses_per_24_hrs', 'route']
     
     setting = {'ndc':str}
-    table = pd.read_csv(path, usecols=setting.keys(),
+    table = cohort.read_csv(path, usecols=setting.keys(),
             dtype=setting, index_col=False)
     table.rename({'ndc':'code'}, axis=1, inplace=True)
     
@@ -270,7 +301,7 @@ def generate_transfers_dict(tablename):
     path = MIMIC_DIR + 'core/{}.csv'.format(tablename)
     
     setting = {'eventtype':str, 'hadm_id':str}
-    table = pd.read_csv(path, usecols=setting.keys(),
+    table = cohort.read_csv(path, usecols=setting.keys(),
             dtype=setting, index_col=False)
     table.rename({'eventtype':'code'}, axis=1, inplace=True)
     
@@ -298,7 +329,7 @@ def generate_no_value_dict(tablename):
     path = MIMIC_DIR + 'icu/{}.csv'.format(tablename)
     
     setting = {'itemid':str}
-    table = pd.read_csv(path, usecols=setting.keys(),
+    table = cohort.read_csv(path, usecols=setting.keys(),
             dtype=setting, index_col=False)
     table.rename({'itemid':'code'}, axis=1, inplace=True)
     
@@ -342,7 +373,7 @@ def generate_value_dict(tablename='outputevents', filedir='icu', value_col='valu
     # load the source table
     src_path = MIMIC_DIR + '{}/{}.csv'.format(filedir, tablename)
     setting = {'itemid':int, value_col:float, 'valueuom':str}
-    with pd.read_csv(src_path, usecols=setting.keys(), index_col=False,
+    with cohort.read_csv(src_path, usecols=setting.keys(), index_col=False,
             chunksize=30000000) as reader:
         for i, chunk in enumerate(reader):
             for itemid, valuenum, valueuom in tqdm(chunk.itertuples(False), total=chunk.shape[0]):
@@ -384,11 +415,42 @@ def generate_value_dict(tablename='outputevents', filedir='icu', value_col='valu
                                     value_record[itemid] = None
                         else:
                             value_record[itemid] = final_value
+    
+    # a shard keeps the counts of all codes, the frequency threshold is applied by reduce_shard_dicts
+    if SHARD is not None:
+        table = pd.DataFrame([[k, v['value'], v['total'], value_record.get(k)] for k, v in freq_record.items()],
+                             columns=['code', V_FREQ, FREQ, 'constant_value'])
+        table.to_csv(IDX_DIR + tablename + '_dict.vpart', index=False)
+        return
+    
+    _output_value_dict(freq_record, value_record, uom_dict, tablename)
 
+
+def _output_value_dict(freq_record:dict, value_record:dict, uom_dict:dict, tablename:str):
+    '''
+    Output the dictionary of a table with values.
+    Called by function generate_value_dict() and reduce_shard_dicts().
+    
+    Parameters:
+    ----
+        freq_record:
+            the total and value frequency of each code: {code: {'total':.., 'value':..}}
+        value_record:
+            the value of each code with values, None if the code has different values
+        uom_dict:
+            the dictionary to normalize units
+        tablename:
+            tablename of the output file
+            
+    Returns:
+    ----
+        No return
+    '''
+    
     table = []
     for k, v in freq_record.items():
-        if v['total'] >= 1000:
-            if v['value'] >= 1000 and value_record[k] == None:
+        if v['total'] >= MIN_FREQ:
+            if v['value'] >= MIN_FREQ and value_record[k] == None:
                 table.append([k, v['value'], v['total'], 1])
             else:
                 table.append([k, 0, v['total'], 0])
@@ -454,6 +516,11 @@ def merge_dict(out_path):
     '''
     Merge dictionaries of all tables together.
     
+    All .dict files are read with fixed dtypes and concatenated once, in
+    sorted file order. Entries are then sorted with a stable sort so that
+    the integer index of a code only depends on the content of the
+    dictionaries, not on the directory listing.
+    
     Parameters:
     ----
         out_path: filepath to output the merged dictionary
@@ -465,17 +532,17 @@ def merge_dict(out_path):
     
     print('Merging all dictionaries together...')
     
-    table = pd.DataFrame(columns=idx_cols)
+    setting = {'code':str, 'code_type':str, V_FREQ:np.int64, FREQ:np.int64,
+               'source_table':str, 'unit_of_measurement':str, 'with_value':np.int8}
     
-    for tablename in os.listdir(IDX_DIR):
-        if '.dict' in tablename:
-            path = IDX_DIR + tablename
-            temp = pd.read_csv(path, dtype={'code':'str'}, index_col=False)
-            table = pd.concat((table, temp), ignore_index=True)
+    paths = sorted(IDX_DIR + i for i in os.listdir(IDX_DIR) if i.endswith('.dict'))
+    table = pd.concat([pd.read_csv(path, usecols=idx_cols, dtype=setting, index_col=False) for path in paths],
+                      ignore_index=True)
+    table = table.loc[:, idx_cols]
     
-    # sort al entries
-    # table.sort_values(['with_value', 'total_frequency'], inplace=True, ignore_index=True)
-    table.sort_values(['code_type', 'with_value', 'total_frequency'], inplace=True, ignore_index=True)
+    # sort all entries (ties are broken by source table and code to keep the index stable)
+    table.sort_values(['code_type', 'with_value', FREQ, 'source_table', 'code'],
+                      kind='mergesort', inplace=True, ignore_index=True)
     table.index += 1
     
     # statistics
@@ -483,7 +550,6 @@ def merge_dict(out_path):
     print('ratio:', value_table[V_FREQ].divide(value_table[FREQ]).mean())
     
     print('total value:', table[V_FREQ].sum(), 'total freq', table[FREQ].sum())
-    # table.rename({V_FREQ:'value_frequency'}, inplace=True)
     
     print('all:')
     print('code_num', 'final', 'mean', 'median','max', 'min', sep='\t')
@@ -498,7 +564,114 @@ def merge_dict(out_path):
     print('-'*20)
     
     # output dict
-    table.to_csv(out_path, index_label='index')
+    with stream_io.open_writer(out_path, text=True) as f:
+        table.to_csv(f, index_label='index')
+    _output_code_table(table, os.path.splitext(out_path)[0] + '.npy')
+
+
+def reduce_shard_dicts(shard_idx_dirs):
+    '''
+    Reduce the code counts of all shards (.part and .vpart files written
+    with MIMIC_SHARD set) into the dictionaries of the whole dataset,
+    then remove duplicate codes and merge them as main() does.
+    
+    Parameters:
+    ----
+        shard_idx_dirs:
+            the index directories of the shards
+            
+    Returns:
+    ----
+        No return
+    '''
+    
+    print('Reducing the dictionaries of {} shards...'.format(len(shard_idx_dirs)))
+    
+    names = sorted(set(i for d in shard_idx_dirs for i in os.listdir(d) if i.endswith(('.part', '.vpart'))))
+    for name in names:
+        paths = [d + name for d in shard_idx_dirs if os.path.exists(d + name)]
+        
+        if name.endswith('_dict.part'):
+            tablename = name[:-len('_dict.part')]
+            setting = {'code':str, 'code_type':str, FREQ:np.int64}
+            table = pd.concat([pd.read_csv(path, dtype=setting, keep_default_na=False, index_col=False)
+                               for path in paths], ignore_index=True)
+            _output_count_dict(table.groupby(['code', 'code_type']).sum(), tablename)
+        
+        else:
+            tablename = name[:-len('_dict.vpart')]
+            setting = {'code':np.int64, V_FREQ:np.int64, FREQ:np.int64, 'constant_value':np.float64}
+            table = pd.concat([pd.read_csv(path, dtype=setting, index_col=False) for path in paths],
+                              ignore_index=True)
+            
+            freq_record = {}
+            value_record = {}
+            for code, group in table.groupby('code'):
+                freq_record[code] = {'value': int(group[V_FREQ].sum()), 'total': int(group[FREQ].sum())}
+                
+                # a code keeps a constant value only if all shards with values have the same one
+                values = group.loc[group[V_FREQ] > 0, 'constant_value']
+                if values.shape[0] != 0:
+                    constant = not values.isna().any() and values.nunique() == 1
+                    value_record[code] = values.iloc[0] if constant else None
+            
+            with open(UOM_SRC + '{}_uom_dict.json'.format(tablename), 'r', encoding='utf8') as f:
+                uom_dict = {int(k):v for k,v in json.load(f).items()}
+            _output_value_dict(freq_record, value_record, uom_dict, tablename)
+    
+    remove_duplicate_codes()
+    merge_dict(IDX_DIR + 'code_dict.csv')
+
+
+def code_hash(token):
+    '''
+    Stable 63-bit id of a code token such as "mimic_51484".
+    Unlike the index in code_dict.csv, it does not change between runs.
+    '''
+    
+    digest = hashlib.blake2b(token.encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> 1
+
+
+def _output_code_table(table:pd.DataFrame, out_path:str):
+    '''
+    Output the merged dictionary as a binary lookup table (.npy),
+    which can be memory-mapped by the tuple stages.
+    
+    Parameters:
+    ----
+        table:
+            The merged dictionary, indexed by the integer code index
+        out_path:
+            filepath of the binary table
+            
+    Returns:
+    ----
+        No return
+    '''
+    
+    codes = table['code'].fillna('').astype(str)
+    code_types = table['code_type'].fillna('').astype(str)
+    sources = table['source_table'].fillna('').astype(str)
+    tokens = code_types + '_' + codes
+    
+    code_table = np.zeros(table.shape[0], dtype=[
+        ('index', np.int32), ('hash_id', np.int64), ('with_value', np.int8),
+        ('source_table', 'U{}'.format(max(1, sources.str.len().max()))),
+        ('code_type', 'U{}'.format(max(1, code_types.str.len().max()))),
+        ('code', 'U{}'.format(max(1, codes.str.len().max())))])
+    
+    code_table['index'] = table.index.values
+    code_table['hash_id'] = tokens.apply(code_hash).values
+    code_table['with_value'] = table['with_value'].values
+    code_table['source_table'] = sources.values
+    code_table['code_type'] = code_types.values
+    code_table['code'] = codes.values
+    
+    if np.unique(code_table['hash_id']).shape[0] != code_table.shape[0]:
+        print('Warning: hash collision in', out_path)
+    
+    np.save(out_path, code_table)
 
 def main():
     # generate a dictionary for each table
@@ -514,6 +687,10 @@ def main():
     generate_value_dict('outputevents', 'icu', 'value')
     generate_value_dict('labevents', 'hosp', 'valuenum')
     generate_value_dict('chartevents', 'icu', 'valuenum')
+    
+    # the dictionaries of shards are reduced by reduce_shard_dicts
+    if SHARD is not None:
+        return
 
     # remove duplicate codes between chartevents and labevents
     remove_duplicate_codes()
@@ -3,9 +3,18 @@ import os
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
+import io
 import json
+import heapq
+import shutil
+import multiprocessing
+import functools
 import rolluptool
-from settings import RESULT_ROOT_DIR, TUPLE_DIR, IDX_DIR, MIMIC_DIR, STRING_TUPLE_DIR, UOM_SRC
+import tuple_index
+import stream_io
+import cohort
+from settings import RESULT_ROOT_DIR, TUPLE_DIR, IDX_DIR, MIMIC_DIR, STRING_TUPLE_DIR, UOM_SRC, TIME_ENCODING, TIME_UNIT
+from settings import VALUE_BUCKET, VALUE_BUCKET_AGG, VALUE_BUCKET_TABLES
 
 
 '''
@@ -13,6 +22,18 @@ Generate tuplets from single form
 '''
 
 
+# flags written in the header of .tri files
+# sorted: the tuples of each patient are ordered by time
+# time: the reference of time offsets (see TIME_ENCODING in settings.py), absent if the time is absolute;
+#       the offsets of patients without admission are from 1970-01-01 until merged (see _first_event_references)
+TRI_FLAGS = {'sparse': 1, 'sorted': 1}
+if TIME_ENCODING is not None:
+    TRI_FLAGS['time'] = TIME_ENCODING
+
+# vocabulary of the values in string_tuples.csv
+VALUE_VOCAB_PATH = RESULT_ROOT_DIR + 'string_value_vocab.csv'
+
+
 def generate_prescriptions_table(tablename):
     '''
     Generate tuples for Rxnorm (prescriptions.csv).
@@ -41,7 +62,7 @@ def generate_prescriptions_table(tablename):
     cols = ['subject_id', 'hadm_id', 'pharmacy_id', 'starttime', 'stoptime', 'drug_type', 'drug', 'gsn', 'ndc', 'prod_strength', 'form_rx', 'dose_val_rx', 'dose_unit_rx', 'form_val_disp', 'form_unit_disp', 'doses_per_24_hrs', 'route']
     
     setting = {'subject_id':'str', 'hadm_id':str, 'ndc':'str', 'starttime':'str'}
-    table = pd.read_csv(path, usecols=setting.keys(),
+    table = cohort.read_csv(path, usecols=setting.keys(),
             parse_dates=['starttime'], infer_datetime_format=True,
             dtype='str', index_col=False)
     
@@ -86,7 +107,7 @@ def generate_diagnoses_icd_table(tablename):
     path = MIMIC_DIR + 'hosp/' + tablename + '.csv'
     cols = ['subject_id', 'hadm_id', 'seq_num', 'icd_code', 'icd_version']
     setting = {'subject_id': 'str', 'hadm_id':int, 'icd_code': 'str', 'icd_version':'str'}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    table = cohort.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
     table.rename({'icd_code':'code', 'icd_version':'code_type'}, axis=1, inplace=True)
     print('number of code before rolling up:', 
           table[['code', 'code_type']].drop_duplicates(keep='first', inplace=False).shape[0])
@@ -113,7 +134,7 @@ def generate_diagnoses_icd_table(tablename):
     table.loc[:, 'code'] = table.loc[:, 'code'].apply(code2idx.get)
     
     # add timestamp for each tuple
-    admissions = pd.read_csv(MIMIC_DIR + 'core/admissions.csv', usecols=['hadm_id','dischtime'],
+    admissions = cohort.read_csv(MIMIC_DIR + 'core/admissions.csv', usecols=['hadm_id','dischtime'],
                 parse_dates=['dischtime'], infer_datetime_format=True, index_col='hadm_id')
     
     table = table.join(admissions, on=['hadm_id']).loc[:,['subject_id', 'hadm_id', 'code', 'dischtime']]
@@ -150,7 +171,7 @@ def generate_drgcodes_table(tablename):
     path = MIMIC_DIR + 'hosp/' + tablename + '.csv'
     cols = ['subject_id', 'hadm_id', 'drg_type', 'drg_code', 'description', 'drg_severity', 'drg_mortality']
     setting = {'subject_id':'str', 'hadm_id':int,'drg_code': 'str'}
-    table = pd.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
+    table = cohort.read_csv(path, usecols=setting.keys(), dtype=setting, index_col=False)
     table.rename({'drg_code':'code'}, axis=1, inplace=True)
     print('number of code before rolling up:', 
           table['code'].drop_duplicates(keep='first', inplace=False).shape[0])
@@ -161,7 +182,7 @@ def generate_drgcodes_table(tablename):
         lambda x:code2idx[x])
     
     # add timestamp
-    admissions = pd.read_csv(MIMIC_DIR + 'core/admissions.csv', usecols=['hadm_id','dischtime'],
+    admissions = cohort.read_csv(MIMIC_DIR + 'core/admissions.csv', usecols=['hadm_id','dischtime'],
                 parse_dates=['dischtime'], infer_datetime_format=True, index_col='hadm_id')
     
     table = table.join(admissions, on=['hadm_id']).loc[:,['subject_id', 'hadm_id', 'code', 'dischtime']]
@@ -206,7 +227,7 @@ def generate_ccs_table(tablename):
     cols = ['subject_id', 'hadm_id', 'seq_num', 'chartdate', 'icd_code', 'icd_version']
     time = 'chartdate'
     setting = {'subject_id':'str', 'hadm_id':str, 'icd_code': str, 'icd_version':int, time:'str'}
-    table = pd.read_csv(path, usecols=setting.keys(), parse_dates=[time],infer_datetime_format=True,
+    table = cohort.read_csv(path, usecols=setting.keys(), parse_dates=[time],infer_datetime_format=True,
         dtype=setting, index_col=False)
     table.rename({'icd_code':'code', 'icd_version':'code_type', time:'time'},
         axis=1, inplace=True)
@@ -223,7 +244,7 @@ def generate_ccs_table(tablename):
     cols = ['subject_id', 'hadm_id', 'chartdate', 'hcpcs_cd', 'seq_num', 'short_description']
     time = 'chartdate'
     setting = {'subject_id':'str', 'hadm_id':str, 'hcpcs_cd': 'str', time:'str'}
-    table1 = pd.read_csv(path, usecols=setting.keys(), parse_dates=[time],infer_datetime_format=True,
+    table1 = cohort.read_csv(path, usecols=setting.keys(), parse_dates=[time],infer_datetime_format=True,
         dtype=setting, index_col=False)
     table1.rename({'hcpcs_cd':'code', time:'time'}, axis=1, inplace=True)
     
@@ -264,7 +285,7 @@ def generate_no_value_table(tablename):
     # load table
     path = MIMIC_DIR + 'icu/{}.csv'.format(tablename)
     setting = {'subject_id':str, 'hadm_id':str, 'itemid':'str'}
-    table = pd.read_csv(path, usecols=['subject_id', 'hadm_id', 'itemid', 'starttime'], parse_dates=['starttime'],
+    table = cohort.read_csv(path, usecols=['subject_id', 'hadm_id', 'itemid', 'starttime'], parse_dates=['starttime'],
             dtype=setting, index_col=False)
     
     table = table.loc[table['itemid'].isin(code2idx), :]
@@ -292,12 +313,7 @@ def generate_output_table(tablename='outputevents'):
     print('\ngenerating tuples of', tablename)
     
     # index dictionary
-    dic = pd.read_csv(IDX_DIR + 'code_dict.csv', dtype='str', index_col=0)
-    dic = dic.loc[dic['source_table'] == tablename, ['code', 'code_type', 'with_value']]
-    code2idx = {i.code:i.code_type + '_' + i.code for i in dic.itertuples(False)}
-    print('code dict size:', len(dic))
-
-    code_with_value = set(dic.loc[dic['with_value'] == '1', 'code'])
+    code2idx, code_with_value = _load_code_dict(tablename, with_value=True)
     
     # patients dictionary
     origin_patients = _load_patients()
@@ -310,11 +326,12 @@ def generate_output_table(tablename='outputevents'):
     # load the source table
     src_path = MIMIC_DIR + '{}/{}.csv'.format('icu', tablename)
     setting = {'subject_id':str, 'hadm_id':str, 'charttime':None, 'itemid':str, 'value':str, 'valueuom':str}
-    with pd.read_csv(src_path, usecols=setting.keys(), index_col=False, parse_dates=['charttime'],
+    with cohort.read_csv(src_path, usecols=setting.keys(), index_col=False, parse_dates=['charttime'],
             chunksize=30000000, dtype=setting) as reader:
         for i, chunk in enumerate(reader):
             patients = {i:[] for i in  origin_patients}
             chunk = chunk.loc[:, ['subject_id', 'hadm_id', 'charttime', 'itemid', 'value', 'valueuom']]
+            chunk = _sort_and_encode_time(chunk, 'subject_id', 'hadm_id', 'charttime')
             
             for pid, hadm, time, itemid, value, valueuom in tqdm(chunk.itertuples(False), total=chunk.shape[0]):     
                 
@@ -362,11 +379,12 @@ def generate_transfers_table(tablename='transfers'):
     # load the source table
     src_path = MIMIC_DIR + '{}/{}.csv'.format('core', tablename)
     setting = {'subject_id':str, 'hadm_id':str, 'intime':None, 'eventtype':str, 'careunit':str}
-    with pd.read_csv(src_path, usecols=setting.keys(), index_col=False, parse_dates=['intime'],
+    with cohort.read_csv(src_path, usecols=setting.keys(), index_col=False, parse_dates=['intime'],
             chunksize=30000000, dtype=setting) as reader:
         for i, chunk in enumerate(reader):
             patients = {i:[] for i in  origin_patients}
             chunk = chunk.loc[:, ['subject_id', 'hadm_id', 'intime', 'eventtype', 'careunit']]
+            chunk = _sort_and_encode_time(chunk, 'subject_id', 'hadm_id', 'intime')
             
             for pid, hadm, time, itemid, care_unit in tqdm(chunk.itertuples(False), total=chunk.shape[0]):     
                 
@@ -389,6 +407,13 @@ def generate_value_table(tablename='labevents', filedir='icu', value_col='valuen
     '''
     Generate tuples for labevents and chartevents respectively.
     
+    If the table is in VALUE_BUCKET_TABLES, the numeric values are aggregated
+    by time bucket before the tuples are created (see _bucket_values).
+    
+    The string tuples carry the integer ID of their text value, and the
+    texts are stored once in the value vocabulary (VALUE_VOCAB_PATH),
+    which is shared by all value tables.
+    
     Parameters:
     ----
         tablename:
@@ -410,12 +435,7 @@ def generate_value_table(tablename='labevents', filedir='icu', value_col='valuen
     assert (value_col in ['value', 'valuenum'])
     
     # index dictionary
-    dic = pd.read_csv(IDX_DIR + 'code_dict.csv', dtype='str', index_col=0)
-    dic = dic.loc[dic['source_table'] == tablename, ['code', 'code_type', 'with_value']]
-    code2idx = {i.code:i.code_type + '_' + i.code for i in dic.itertuples(False)}
-    print('code dict size:', len(dic))
-
-    code_with_value = set(dic.loc[dic['with_value'] == '1', 'code'])
+    code2idx, code_with_value = _load_code_dict(tablename, with_value=True)
     
     # patients dictionary
     origin_patients = _load_patients()
@@ -425,6 +445,9 @@ def generate_value_table(tablename='labevents', filedir='icu', value_col='valuen
         uom_dict = json.load(f)
         uom_dict = {k:v for k,v in uom_dict.items()}
     
+    # the vocabulary of string values (extended by this table)
+    vocab, vocab_count = _load_value_vocab()
+    
     # load the source table
     src_path = MIMIC_DIR + '{}/{}.csv'.format(filedir, tablename)
     setting = {'subject_id':str, 'hadm_id':str, 'charttime':None, 'itemid':str, 'value':str,
@@ -432,13 +455,16 @@ def generate_value_table(tablename='labevents', filedir='icu', value_col='valuen
     if value_col == 'valuenum':
         setting['value'] = str
         
-    with pd.read_csv(src_path, usecols=setting.keys(), index_col=False, parse_dates=['charttime'],
+    with cohort.read_csv(src_path, usecols=setting.keys(), index_col=False, parse_dates=['charttime'],
             chunksize=20000000, dtype=setting) as reader:
         for i, chunk in enumerate(reader):
             patients = {i:[] for i in  origin_patients}
             patients_str = {i:[] for i in  origin_patients}
             
             chunk = chunk.loc[:, ['subject_id', 'hadm_id', 'charttime', 'itemid', 'value', value_col, 'valueuom']]
+            if VALUE_BUCKET is not None and tablename in VALUE_BUCKET_TABLES:
+                chunk = _bucket_values(chunk, value_col, code_with_value, uom_dict)
+            chunk = _sort_and_encode_time(chunk, 'subject_id', 'hadm_id', 'charttime')
             for pid, hadm, time, itemid, value, valuenum, valueuom in tqdm(chunk.itertuples(False), total=chunk.shape[0]):     
                 
                 # Filter unwanted codes
@@ -486,24 +512,50 @@ def generate_value_table(tablename='labevents', filedir='icu', value_col='valuen
                 # add the item to patients' record
                 patients[pid].append(tuple)
                 
-                # add the string item to patients' record
+                # add the string item to patients' record, with the ID of its value
                 if tuple[3] == '_STRING':
+                    value_id = vocab.setdefault(tuple_str[3], len(vocab))
+                    if value_id == len(vocab_count):
+                        vocab_count.append(0)
+                    vocab_count[value_id] += 1
+                    
+                    tuple_str[3] = str(value_id)
                     patients_str[pid].append(tuple_str)
 
             # output tuples
             _value_table2tuples(patients, TUPLE_DIR + tablename+str(i))
             _value_table2tuples(patients_str, STRING_TUPLE_DIR + '{}{}{}'.format(tablename, '_string_', i))
+    
+    _output_value_vocab(vocab, vocab_count)
 
 
-def merge_tuples(src_dir, cols, out_path):
+def merge_tuples(src_dir, cols, out_path, n_jobs=1):
     '''
     Merge tuples of all tables together.
     
+    Each .tri file is read as a stream of patient blocks. The streams are
+    merged by patient ID (a file may contain any subset of patients),
+    and the time-sorted blocks of a patient are merged with a heap, so the
+    tuples of a patient are never re-sorted as a whole.
+    Blocks of files with the "sorted" header flag are ordered by time at
+    generation, other blocks are sorted before merging.
+    Header-less (dense) .tri files of earlier versions are in the order of
+    patients.csv, not of IDs, so they are rejected: generate them again.
+    With relative time, the offsets of patients without admission are made
+    relative to their first event time in all tables (see _first_event_references).
+    
+    If n_jobs > 1, the patient IDs are split into ranges of similar size
+    which are merged in separate processes (seeking with the .dir files),
+    and the outputs of the ranges are concatenated in order. The result is
+    identical to the serial merge. Compressed .tri files cannot be seeked,
+    so they are merged in one process.
+    
     Parameters:
     ----
         src_dir: source directory of tuples
         cols: column names of output file
         out_path: filepath to output the merged tuples
+        n_jobs: number of processes
             
     Returns:
     ----
@@ -512,57 +564,263 @@ def merge_tuples(src_dir, cols, out_path):
     
     print("\nMerging tuples in {}".format(src_dir))
     
-    tuples_out = open(out_path, 'w', encoding='utf8')
-    tuples_out.write(','.join(cols) + '\n')
+    iFiles = sorted(i for i in os.listdir(src_dir) if stream_io.strip_ext(i).endswith('.tri'))
+    _check_tri_headers(src_dir, iFiles)
+    ranges = _patient_ranges(src_dir, iFiles, n_jobs) if n_jobs > 1 else [(None, None)]
     
-    iFiles = os.listdir(src_dir)
-    iFiles = [open(src_dir + i, 'r', encoding='utf8') for i in iFiles if '.tri' in i]
+    header = (','.join(cols) + '\n').encode('utf8')
     
-    while True:
-        p = []
-        data = []
-        for f in iFiles:
-            pp, dd = _get_patient_data(f, 10000)
-            
-            if len(pp) == 0:
-                print('Merging finished.')
-                return
-                
-            p.append(pp)
-            data.append(dd)
+    if len(ranges) == 1:
+        with stream_io.open_writer(out_path) as tuples_out:
+            tuples_out.write(header)
+            index = _merge_range(src_dir, iFiles, None, None, tuples_out)
+    
+    else:
+        print('number of patient ranges:', len(ranges))
+        tasks = [(src_dir, iFiles, lo, hi, '{}.part{}'.format(out_path, i)) for i, (lo, hi) in enumerate(ranges)]
+        with multiprocessing.Pool(min(n_jobs, len(tasks))) as pool:
+            parts = pool.map(_merge_range_part, tasks)
         
-        for i in range(1, len(p)):
-            if not (p[i] == p[i-1]):
-                print('error!')
-                exit(1)
+        with stream_io.open_writer(out_path) as tuples_out:
+            tuples_out.write(header)
+        
+        # compressed parts are concatenated as they are (gzip members / zstd frames)
+        index = []
+        start = len(header)
+        with open(tuples_out.path, 'ab') as f_out:
+            for part, part_index in parts:
+                # offsets in the part are relative to the beginning of the part
+                index += [(p, start + offset, length, count) for p, offset, length, count in part_index]
+                start += sum(i[2] for i in part_index)
                 
-        for i, p_id in enumerate(p[0]):
-            temp = []
-            
-            for slice in data:
-                temp += slice[i]
-            
-            # if the patient has no tuple, then ignore him/her
-            if len(temp) == 0:
+                with open(part, 'rb') as f:
+                    shutil.copyfileobj(f, f_out, 1 << 24)
+                os.remove(part)
+    
+    # byte offset of each patient in the output
+    tuple_index.save_index(index, out_path)
+    
+    print('Merging finished.')
+
+
+def _check_tri_headers(src_dir, iFiles):
+    '''
+    Check that all .tri files are sparse, i.e. ordered by patient ID
+    '''
+    
+    for name in iFiles:
+        with stream_io.open_reader(src_dir + name) as f:
+            flags = _read_tri_header(f)
+        if flags.get('sparse') != '1':
+            raise ValueError('{} has no "#tri sparse=1" header: dense .tri files are not ordered by patient ID '
+                             'and cannot be merged, generate the tuples again'.format(src_dir + name))
+
+
+def _patient_ranges(src_dir, iFiles, n):
+    '''
+    Split the patient IDs into at most n ranges [lo, hi) with a similar number of tuples,
+    according to the .dir files. None means no bound.
+    '''
+    
+    if any(stream_io.is_compressed(i) for i in iFiles):
+        print('compressed .tri files, merging in one process')
+        return [(None, None)]
+    
+    dirs = [_load_tri_dir(src_dir + i) for i in iFiles]
+    if len(dirs) == 0 or any(d is None for d in dirs):
+        print('.dir files not found, merging in one process')
+        return [(None, None)]
+    
+    counts = pd.concat(dirs).groupby('patient_id')['count'].sum()
+    if counts.shape[0] == 0:
+        return [(None, None)]
+    
+    cum = counts.values.cumsum()
+    cuts = np.searchsorted(cum, cum[-1] * np.arange(1, n) / n, side='right')
+    bounds = sorted(set(int(counts.index[i]) for i in cuts if 0 < i < counts.shape[0]))
+    
+    bounds = [None] + bounds + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _load_tri_dir(tri_path):
+    '''
+    Load the patient directory (.dir) of a .tri file, or None if it does not exist
+    '''
+    
+    dir_path = os.path.splitext(stream_io.strip_ext(tri_path))[0] + '.dir'
+    if not os.path.exists(dir_path):
+        return None
+    
+    return pd.read_csv(dir_path, dtype=np.int64, index_col=False)
+
+
+def _merge_range_part(args):
+    '''
+    Merge the patients in [lo, hi) into a part file.
+    Called by function merge_tuples().
+    '''
+    
+    src_dir, iFiles, lo, hi, out_path = args
+    
+    with stream_io.open_writer(out_path) as tuples_out:
+        index = _merge_range(src_dir, iFiles, lo, hi, tuples_out)
+    
+    return tuples_out.path, index
+
+
+def _merge_range(src_dir, iFiles, lo, hi, tuples_out):
+    '''
+    Merge the tuples of patients with lo <= ID < hi in all .tri files
+    and write them to tuples_out (opened in binary mode).
+    Return the (patient ID, offset, length, count) of each written patient.
+    '''
+    
+    files = []
+    streams = []
+    presorted = []
+    time_refs = set()
+    for k, name in enumerate(iFiles):
+        # the .dir offsets are byte offsets: seek in binary mode, then decode the lines
+        f = stream_io.open_reader(src_dir + name)
+        flags = _read_tri_header(f)
+        presorted.append(flags.get('sorted') == '1')
+        time_refs.add(flags.get('time'))
+        
+        # seek to the first patient of the range (other patients are skipped while reading)
+        directory = _load_tri_dir(src_dir + name) if lo is not None and not stream_io.is_compressed(name) else None
+        if directory is not None:
+            i = np.searchsorted(directory['patient_id'].values, lo)
+            if i == directory.shape[0]:
+                f.close()
                 continue
-            
-            temp.sort(key=lambda x:x[1])
-            
-            for l in temp:
-                tuples_out.write(p_id + ',' + ','.join(l) + '\n')
+            f.seek(directory['offset'].values[i])
+        
+        f = io.TextIOWrapper(f, encoding='utf8')
+        files.append(f)
+        
+        # patients are ordered by ID in all .tri files
+        streams.append(_keyed_patient_blocks(f, k, lo, hi))
+    
+    assert len(time_refs) <= 1, 'the .tri files have different time encodings: {}'.format(time_refs)
+    encoding = time_refs.pop() if len(time_refs) else None
+    patient_time_key = _patient_time_key(encoding)
+    
+    # the offsets of patients without admission are made relative to their first event
+    shifts = {}
+    if encoding is not None:
+        shifts = (_first_event_references() // TIME_UNIT).astype(np.int64).to_dict()
+    admissions = set(_load_time_references()[1].index) if encoding == 'admission' else set()
+    
+    index = []
+    p_id = None
+    blocks = []
+    time_key = None
+    for _, k, p, data in heapq.merge(*streams):
+        if p != p_id:
+            _write_patient_tuples(tuples_out, p_id, blocks, index, time_key, shifts.get(p_id, 0), admissions)
+            p_id = p
+            blocks = []
+            time_key = patient_time_key(p)
+        
+        if len(data) != 0:
+            # blocks of files written with the sorted flag are already ordered by time
+            if not presorted[k]:
+                data.sort(key=time_key)
+            blocks.append(data)
+    
+    _write_patient_tuples(tuples_out, p_id, blocks, index, time_key, shifts.get(p_id, 0), admissions)
+    
+    for f in files:
+        f.close()
+    
+    return index
+
+
+def _keyed_patient_blocks(f, k, lo=None, hi=None):
+    '''
+    Patient blocks of the k-th .tri file with lo <= ID < hi,
+    keyed by (patient ID, k) for merging
+    '''
+    
+    for p, data in _read_patient_blocks(f):
+        key = int(p)
+        if lo is not None and key < lo:
+            continue
+        if hi is not None and key >= hi:
+            return
+        
+        yield key, k, p, data
+
+
+def _patient_time_key(encoding):
+    '''
+    Return a function giving the key by which the tuples of a patient are ordered:
+    absolute times are ordered as text, time offsets as integers (unknown at the end),
+    and offsets from admissions by their absolute time (see _sort_and_encode_time).
+    '''
+    
+    if encoding != 'admission':
+        time_key = _offset_key if encoding is not None else _text_key
+        return lambda p: time_key
+    
+    patient_ref, admission_ref = (i.to_dict() for i in _load_time_references())
+    return lambda p: functools.partial(_admission_offset_key, patient_ref=patient_ref.get(p, 0),
+                                       admission_ref=admission_ref)
+
+
+def _text_key(line):
+    return line[1]
+
+
+def _offset_key(line):
+    return int(line[1]) if line[1] != '' else float('inf')
+
+
+def _admission_offset_key(line, patient_ref, admission_ref):
+    if line[1] == '':
+        return float('inf')
+    return admission_ref.get(line[0], patient_ref) + int(line[1]) * TIME_UNIT
+
+
+def _write_patient_tuples(f, p_id, blocks, index, time_key=_text_key, shift=0, admissions=()):
+    '''
+    Merge the time-sorted blocks of a patient and output the tuples,
+    then record the offset, length and number of tuples of the patient in index.
+    The time offsets are decreased by shift, except those from the given admissions.
+    If the patient has no tuple, then ignore him/her.
+    '''
+    
+    if len(blocks) == 0:
+        return
     
+    lines = heapq.merge(*blocks, key=time_key)
+    if shift != 0:
+        lines = ([l[0], str(int(l[1]) - shift) if l[1] != '' and l[0] not in admissions else l[1], l[2], l[3]]
+                 for l in lines)
+    
+    lines = [p_id + ',' + ','.join(l) + '\n' for l in lines]
+    offset = f.tell()
+    length = f.write(''.join(lines).encode('utf8'))
+    index.append((int(p_id), offset, length, len(lines)))
 
 
 # functions for data IO
-def _load_code_dict(tablename):
+def _load_code_dict(tablename, with_value=False):
     '''
-    load the dictionary.
+    load the dictionary from the memory-mapped binary table (code_dict.npy).
+    If with_value is True, the set of codes with value is returned as well.
     '''
     
-    dic = pd.read_csv(IDX_DIR + 'code_dict.csv', dtype='str', index_col=0)
-    dic = dic.loc[dic['source_table'] == tablename, ['code', 'code_type', 'with_value']]
-    code2idx = {i.code:i.code_type + '_' + i.code for i in dic.itertuples(False)}
+    dic = np.load(IDX_DIR + 'code_dict.npy', mmap_mode='r')
+    dic = dic[dic['source_table'] == tablename]
+    code2idx = {str(code):str(code_type) + '_' + str(code) for code, code_type in zip(dic['code'], dic['code_type'])}
     print('code dict size:', len(dic))
+    
+    if with_value:
+        code_with_value = set(str(code) for code in dic['code'][dic['with_value'] == 1])
+        return code2idx, code_with_value
+    
     return code2idx
 
 
@@ -584,16 +842,18 @@ def _table2tuples(table, oFile):
     
     # load all patients
     patients = _load_patients()
+    
+    # the tuples of each patient are appended in the order of time
+    table = _sort_and_encode_time(table, *table.columns[[0, 1, 3]])
 
     for p, v, c, t in tqdm(table.itertuples(False), total=table.shape[0]):
         patients[p].append((v, str(t), c, ''))
     
-    with open(oFile + '.tri', 'w', encoding='utf8') as f:
-        for id, info in patients.items():
-            f.write(str(id) + '\n')
-            for l in info:
-                f.write(','.join(l) + '\n')
-            f.write('\n')
+    _write_tri(patients, oFile)
+    
+    # codes of this table never carry a value
+    _output_counter(table.iloc[:, 2], np.full(table.shape[0], ''), oFile)
+    _output_patient_stats(patients, oFile)
 
 
 def _value_table2tuples(patients, oFile):
@@ -613,13 +873,278 @@ def _value_table2tuples(patients, oFile):
         No return
     '''
     
-    with open(oFile + ".tri", 'w', encoding='utf8') as f:
-        for id, info in patients.items():
-            f.write(id + '\n')
-            for l in info:
-                l[3] = l[3].replace(',', '/')
-                f.write(','.join(l) + '\n')
-            f.write('\n')
+    codes, values = _write_tri(patients, oFile)
+    
+    _output_counter(codes, values, oFile)
+    _output_patient_stats(patients, oFile)
+
+
+def _write_tri(patients, oFile):
+    '''
+    Output tuples as a sparse .tri file: only patients with tuples are
+    written, in the order of their IDs. A directory (.dir) with the byte
+    offset and the number of tuples of each patient is written as well.
+    
+    Parameters:
+    ----
+        patients:
+            tuples of each patient, [admission_id, time, code, value]
+        oFile:
+            file path of the output file
+            
+    Returns:
+    ----
+        codes:
+            code column of the written tuples
+        values:
+            value column of the written tuples
+    '''
+    
+    codes = []
+    values = []
+    directory = []
+    
+    with stream_io.open_writer(oFile + '.tri') as f:
+        offset = f.write('#tri {}\n'.format(' '.join('{}={}'.format(k, v) for k, v in TRI_FLAGS.items())).encode('utf8'))
+        
+        for id in sorted((i for i, info in patients.items() if len(info) != 0), key=int):
+            lines = [str(id)]
+            for l in patients[id]:
+                value = l[3].replace(',', '/')
+                lines.append(','.join((l[0], l[1], l[2], value)))
+                codes.append(l[2])
+                values.append(value)
+            
+            block = ('\n'.join(lines) + '\n\n').encode('utf8')
+            directory.append((id, offset, len(lines) - 1))
+            offset += f.write(block)
+    
+    directory = pd.DataFrame(directory, columns=['patient_id', 'offset', 'count'])
+    directory.to_csv(oFile + '.dir', index=False)
+    
+    return codes, values
+
+
+def _output_counter(codes, values, oFile):
+    '''
+    Output the total and numeric-value frequency of each code in a .tri file,
+    so that post_process does not need to re-count them in tuples.csv.
+    
+    Parameters:
+    ----
+        codes:
+            code column of the tuples
+        values:
+            value column of the tuples
+        oFile:
+            file path of the output file
+            
+    Returns:
+    ----
+        No return
+    '''
+    
+    table = pd.DataFrame({'code': np.asarray(codes, dtype=object), 'value': np.asarray(values, dtype=object)})
+    table['value'] = pd.to_numeric(table['value'], errors='coerce').notna()
+    
+    counter = table.groupby('code')['value'].agg(['size', 'sum'])
+    counter.columns = ['total_frequency', 'value_frequency']
+    counter.to_csv(oFile + '.cnt', index_label='code')
+
+
+def _output_patient_stats(patients, oFile):
+    '''
+    Output the number of tuples and the first/last event time
+    of each patient with tuples in a .tri file.
+    The event times are absolute: with TIME_ENCODING, the time of an offset is
+    its reference + offset (see _sort_and_encode_time), so the offsets
+    from different admissions are compared by their absolute time.
+    
+    Parameters:
+    ----
+        patients:
+            tuples of each patient, [admission_id, time, code, value]
+        oFile:
+            file path of the output file
+            
+    Returns:
+    ----
+        No return
+    '''
+    
+    if TIME_ENCODING is not None:
+        patient_ref, admission_ref = (i.to_dict() for i in _load_time_references())
+        if TIME_ENCODING != 'admission':
+            admission_ref = {}
+    
+    stats = []
+    for id, info in patients.items():
+        if len(info) == 0:
+            continue
+        
+        if TIME_ENCODING is not None:
+            ref = patient_ref.get(id, 0)
+            times = [admission_ref.get(l[0], ref) + int(l[1]) * TIME_UNIT for l in info if l[1] != '']
+        else:
+            times = [l[1] for l in info if l[1] != 'NaT' and l[1] != '']
+        
+        if len(times) == 0:
+            stats.append((id, len(info), np.nan, np.nan))
+        else:
+            stats.append((id, len(info), min(times), max(times)))
+    
+    stats = pd.DataFrame(stats, columns=['patient_id', 'event_count', 'first_event_time', 'last_event_time'])
+    if TIME_ENCODING is not None:
+        for col in ['first_event_time', 'last_event_time']:
+            stats[col] = pd.to_datetime(stats[col].astype(np.float64), unit='s').dt.strftime('%Y-%m-%d %H:%M:%S')
+    stats.to_csv(oFile + '.pst', index=False)
+
+
+def _load_value_vocab():
+    '''
+    Load the vocabulary of string values written by previous value tables.
+    Return a dictionary mapping values to IDs, and the number of occurrences of each ID.
+    '''
+    
+    if not os.path.exists(VALUE_VOCAB_PATH):
+        return {}, []
+    
+    table = pd.read_csv(VALUE_VOCAB_PATH, dtype={'value_id':np.int64, 'value':str, 'frequency':np.int64},
+                        keep_default_na=False, index_col=False)
+    vocab = dict(zip(table['value'], table['value_id']))
+    return vocab, table['frequency'].tolist()
+
+
+def _output_value_vocab(vocab, vocab_count):
+    '''
+    Output the vocabulary of string values: value_id, value, frequency
+    '''
+    
+    table = pd.DataFrame({'value_id': np.arange(len(vocab_count)),
+                          'value': sorted(vocab, key=vocab.get),
+                          'frequency': vocab_count})
+    table.to_csv(VALUE_VOCAB_PATH, index=False)
+
+
+def _sort_by_patient_time(table, patient_col, time_col):
+    '''
+    Stable sort of a table by patient and time, so that the tuples of
+    each patient are generated in the order of time (NaT at the end,
+    the same order as sorting the time strings).
+    '''
+    
+    time = table[time_col]
+    if pd.api.types.is_datetime64_any_dtype(time):
+        time_key = time.values.astype('datetime64[ns]').view(np.int64)
+        time_key[time.isna().values] = np.iinfo(np.int64).max
+    elif pd.api.types.is_numeric_dtype(time):
+        time_key = np.nan_to_num(time.values.astype(np.float64), nan=np.inf)
+    else:
+        time_key = pd.factorize(time.astype(str), sort=True)[0]
+    patient_key = pd.factorize(table[patient_col], sort=True)[0]
+    
+    return table.iloc[np.lexsort((time_key, patient_key))]
+
+
+def _sort_and_encode_time(table, patient_col, hadm_col, time_col):
+    '''
+    Sort a table by patient and time (see _sort_by_patient_time).
+    If TIME_ENCODING is set, the time column is replaced by the integer offset
+    (text, empty if unknown) from the reference time. The tuples of a patient are
+    ordered by the absolute time of their offsets (reference + offset), which is
+    chronological even if the offsets of a patient have different references
+    (TIME_ENCODING 'admission'), and is the order used by merge_tuples.
+    '''
+    
+    if TIME_ENCODING is None:
+        return _sort_by_patient_time(table, patient_col, time_col)
+    
+    seconds = _seconds(table[time_col])
+    ref = _time_references(table[patient_col], table[hadm_col])
+    offset = np.floor((seconds - ref) / TIME_UNIT)
+    
+    # by the absolute time of the offset, then by the time within the unit
+    time_key = np.nan_to_num(ref + offset * TIME_UNIT, nan=np.inf)
+    patient_key = pd.factorize(table[patient_col], sort=True)[0]
+    order = np.lexsort((np.nan_to_num(seconds, nan=np.inf), time_key, patient_key))
+    
+    offset = offset[order]
+    text = np.where(np.isnan(offset), '', np.nan_to_num(offset).astype(np.int64).astype(str))
+    return table.iloc[order].assign(**{time_col: text.astype(object)})
+
+
+def _seconds(time):
+    '''
+    Seconds since 1970-01-01 of a datetime Series, NaN for NaT
+    '''
+    
+    seconds = time.values.astype('datetime64[s]').astype(np.int64).astype(np.float64)
+    seconds[time.isna().values] = np.nan
+    return seconds
+
+
+def _time_references(patient, hadm):
+    '''
+    Reference times (seconds since 1970-01-01) of time offsets: the admission time of
+    the tuple if TIME_ENCODING is 'admission' and the admission is known, otherwise the
+    first admission time of the patient. The offsets of patients without admission are
+    from 1970-01-01 (reference 0), and are made relative to their first event time by
+    merge_tuples (see _first_event_references).
+    '''
+    
+    patient_ref, admission_ref = _load_time_references()
+    ref = patient.map(patient_ref).fillna(0)
+    if TIME_ENCODING == 'admission':
+        ref = hadm.map(admission_ref).fillna(ref)
+    
+    return ref.values.astype(np.float64)
+
+
+def _first_event_references(src_dirs=(TUPLE_DIR, STRING_TUPLE_DIR)):
+    '''
+    The reference times (seconds since 1970-01-01) of the patients without admission:
+    their first event time in all tables (tuples and string tuples), taken from the
+    patient statistics (.pst) of the tables and truncated to TIME_UNIT, as their
+    offsets are from 1970-01-01 in the .tri files.
+    
+    Parameters:
+    ----
+        src_dirs:
+            directories of the .tri files
+    
+    Returns:
+    ----
+        A pandas.Series indexed by patient ID (str)
+    '''
+    
+    paths = [d + i for d in src_dirs if os.path.isdir(d) for i in sorted(os.listdir(d)) if i.endswith('.pst')]
+    if len(paths) == 0:
+        return pd.Series(dtype=np.float64)
+    
+    stats = pd.concat([pd.read_csv(path, usecols=['patient_id', 'first_event_time'], dtype={'patient_id':str},
+                                   index_col=False) for path in paths], ignore_index=True)
+    first = pd.to_datetime(stats['first_event_time'], format='%Y-%m-%d %H:%M:%S')
+    
+    seconds = pd.Series(_seconds(first), index=stats['patient_id'].values).dropna()
+    seconds = seconds[~seconds.index.isin(_load_time_references()[0].index)]
+    return seconds.groupby(level=0).min() // TIME_UNIT * TIME_UNIT
+
+
+@functools.lru_cache(maxsize=None)
+def _load_time_references():
+    '''
+    Load the reference times (seconds since 1970-01-01) of time offsets:
+    the first admission time of each patient, and the time of each admission.
+    '''
+    
+    admissions = cohort.read_csv(MIMIC_DIR + 'core/admissions.csv', usecols=['subject_id', 'hadm_id', 'admittime'],
+                             dtype={'subject_id':str, 'hadm_id':str}, parse_dates=['admittime'], index_col=False)
+    admissions = admissions.dropna(subset=['admittime'])
+    seconds = admissions['admittime'].values.astype('datetime64[s]').astype(np.int64)
+    
+    admission_ref = pd.Series(seconds, index=admissions['hadm_id'].values)
+    patient_ref = admission_ref.groupby(admissions['subject_id'].values).min()
+    return patient_ref, admission_ref
 
 
 def _load_patients():
@@ -627,11 +1152,73 @@ def _load_patients():
     load all patients' ID.
     '''
     
-    patients = pd.read_csv(MIMIC_DIR + 'core/patients.csv', usecols=['subject_id'], dtype='str')
+    patients = cohort.read_csv(MIMIC_DIR + 'core/patients.csv', usecols=['subject_id'], dtype='str')
     patients = {i:[] for i in patients['subject_id']}
     return patients
 
 
+def _bucket_values(table, value_col, code_with_value, uom_dict, bucket=VALUE_BUCKET, agg=VALUE_BUCKET_AGG):
+    '''
+    Aggregate the numeric values of each (patient, admission, code) by time bucket.
+    
+    The values are converted to the main unit of their code first, and the
+    rows of a bucket are replaced by one row at the beginning of the bucket,
+    with the aggregated value in the main unit. Other rows (string values,
+    invalid units, codes without value, rows without time) are kept as they are.
+    A bucket split between two chunks of the source table gives two rows.
+    
+    Parameters:
+    ----
+        table:
+            chunk of labevents/chartevents with columns
+            subject_id, hadm_id, charttime, itemid, value, <value_col>, valueuom
+        value_col:
+            the column of numeric values
+        code_with_value:
+            the codes with value
+        uom_dict:
+            the units of measurement of the codes and their conversion factors
+        bucket:
+            the size of time buckets (pandas frequency, e.g. '1h')
+        agg:
+            the aggregation of the values in a bucket
+            
+    Returns:
+    ----
+        the table with aggregated rows
+    '''
+    
+    # conversion factor of each (code, unit) to the main unit, NaN if the value cannot be converted
+    factors = {}
+    for itemid in set(table['itemid'].unique()) & set(code_with_value):
+        for unit, factor in uom_dict.get(itemid, {}).items():
+            if unit != '<main>' and factor != 0:
+                factors[(itemid, unit)] = factor
+        if '<main>' in uom_dict.get(itemid, {}):
+            factors[(itemid, uom_dict[itemid]['<main>'])] = 1
+    
+    units = table['valueuom'].map(_normalize_unit)
+    factor = pd.Series(list(zip(table['itemid'], units)), index=table.index).map(factors)
+    
+    numeric = factor.notna() & table[value_col].notna() & table['charttime'].notna()
+    if not numeric.any():
+        return table
+    
+    values = table.loc[numeric, :].sort_values('charttime', kind='mergesort')
+    values = values.assign(charttime=values['charttime'].dt.floor(bucket),
+                           value_num=values[value_col] * factor[values.index])
+    
+    grouped = values.groupby(['subject_id', 'hadm_id', 'itemid', 'charttime'], sort=False, dropna=False)['value_num']
+    values = grouped.agg(agg).reset_index()
+    
+    main_units = {k:v['<main>'] for k, v in uom_dict.items() if '<main>' in v}
+    values = values.assign(**{value_col: values['value_num'], 'valueuom': values['itemid'].map(main_units),
+                              'value': values['value_num'].astype(str)})
+    
+    print('{} numeric values aggregated into {} buckets'.format(numeric.sum(), values.shape[0]))
+    return pd.concat([table.loc[~numeric, :], values.loc[:, table.columns]], ignore_index=True)
+
+
 def _normalize_unit(unit):
     '''
     normalize unit of measurement
@@ -647,20 +1234,32 @@ def _normalize_unit(unit):
             return unit
 
 
-def _get_patient_data(f, batch_size):
+def _read_tri_header(f):
     '''
-    Read a batch of patients' ID and corresponding tuples
+    Read the header of a .tri file (opened in text or binary mode) and return its flags.
+    Files without a header (dense format) return no flags.
     '''
     
-    p = []
-    d = []
+    line = f.readline()
+    if isinstance(line, bytes):
+        line = line.decode('utf8')
+    if line.startswith('#tri'):
+        return dict(i.split('=') for i in line.split()[1:])
+    
+    f.seek(0)
+    return {}
+
+
+def _read_patient_blocks(f):
+    '''
+    Read patients' ID and corresponding tuples from a .tri file, one patient at a time
+    '''
     
-    for i in range(batch_size):
+    while True:
         patient = f.readline()[:-1]
         if patient == '':
-            break
+            return
         
-        p.append(patient)
         data = []
         
         while True:
@@ -670,13 +1269,15 @@ def _get_patient_data(f, batch_size):
         
             line = line.strip().split(',')
             data.append(line)
-
-        d.append(data)
         
-    return p, d
+        yield patient, data
 
 
-def main():
+def main(n_jobs=1):
+    # the value vocabulary is built again by the tables
+    if os.path.exists(VALUE_VOCAB_PATH):
+        os.remove(VALUE_VOCAB_PATH)
+    
     # generate a contemporary tuple file for each table
     generate_prescriptions_table('prescriptions')
     generate_ccs_table('ccs')
@@ -693,8 +1294,8 @@ def main():
     
     # merge all the tuple files together
     cols = ['patient_id', 'admission_id', 'time', 'code', 'value']
-    merge_tuples(TUPLE_DIR, cols, RESULT_ROOT_DIR + 'tuples.csv')
-    merge_tuples(STRING_TUPLE_DIR, cols, RESULT_ROOT_DIR + 'string_tuples.csv')
+    merge_tuples(TUPLE_DIR, cols, RESULT_ROOT_DIR + 'tuples.csv', n_jobs)
+    merge_tuples(STRING_TUPLE_DIR, cols, RESULT_ROOT_DIR + 'string_tuples.csv', n_jobs)
 
 
 if __name__=='__main__':
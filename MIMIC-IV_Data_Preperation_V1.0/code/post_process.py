@@ -1,21 +1,43 @@
 import sys
 import os
+import io
+import multiprocessing
 import numpy as np
 import pandas as pd
 import json
-from tqdm import tqdm
-from settings import RESULT_ROOT_DIR, TUPLE_DIR, IDX_DIR, MIMIC_DIR
+from settings import RESULT_ROOT_DIR, TUPLE_DIR, IDX_DIR, MIMIC_DIR, TIME_ENCODING
+import tuple_codec
+import generate_tuples
+import stream_io
+import cohort
+import columnar_store
+import postings
+import sqlite_export
+import arrow_export
+import value_norm
 
 
-def generate_patient_dict(tuple_path, out_path):
+# maximum number of processes of scan_tuples, each of which holds a parsed block in memory
+MAX_SCAN_JOBS = 8
+
+
+def generate_patient_dict(recorded_patients, out_path, events=None):
     '''
     Generate a patients' dictionary which contains 
     personal information of each patient.
+    If the tuples have relative time (see TIME_ENCODING in settings.py), the reference time
+    of each patient is added as reference_time: in_time, or the first event time
+    in all tables for patients without admission (see generate_tuples._first_event_references).
     
     Parameters:
     ----
+        recorded_patients:
+            IDs of patients with records in tuples.csv
         out_path:
             filepath to output the dictionary
+        events:
+            per-patient event counts and first/last event times
+            (see _count_patient_events), added to the dictionary if given
             
     Returns:
     ----
@@ -23,21 +45,19 @@ def generate_patient_dict(tuple_path, out_path):
     '''
     
     # load core/patients.csv
-    patients = pd.read_csv(MIMIC_DIR + 'core/patients.csv', dtype={'subject_id':'str'}, index_col=False)
+    patients = cohort.read_csv(MIMIC_DIR + 'core/patients.csv', usecols=['subject_id', 'gender', 'anchor_age'],
+                dtype={'subject_id':'str'}, index_col=False)
     print('patients', patients.shape)
     
     # load hosp/admission.csv
-    admissions = pd.read_csv(MIMIC_DIR + 'core/admissions.csv', dtype={'subject_id':'str'},
+    admissions = cohort.read_csv(MIMIC_DIR + 'core/admissions.csv', dtype={'subject_id':'str'},
+                usecols=['subject_id', 'admittime', 'dischtime', 'deathtime', 'ethnicity', 'marital_status', 'language'],
                 parse_dates=['admittime', 'dischtime'], infer_datetime_format=True, index_col=False)
     
     # add patients' first check-in time and last check-out time
-    admissions.sort_values(['admittime'], ascending=True, inplace=True)
-    first_info = admissions.drop_duplicates(['subject_id'], keep='first', inplace=False)
-    admissions.sort_values(['dischtime'], ascending=False, inplace=True)
-    last_info = admissions.drop_duplicates(['subject_id'], keep='first', inplace=False)
-    
-    first_info = first_info.loc[:,['subject_id', 'admittime', 'ethnicity','marital_status','language']]
-    last_info = last_info.loc[:,['subject_id', 'dischtime', 'deathtime']]
+    grouped = admissions.groupby('subject_id')
+    first_info = admissions.loc[grouped['admittime'].idxmin(), ['subject_id', 'admittime', 'ethnicity','marital_status','language']]
+    last_info = admissions.loc[grouped['dischtime'].idxmax(), ['subject_id', 'dischtime', 'deathtime']]
     first_info.set_index(['subject_id'], inplace=True)
     last_info.set_index(['subject_id'], inplace=True)
     print('first_last_info', first_info.shape, last_info.shape)
@@ -59,7 +79,6 @@ def generate_patient_dict(tuple_path, out_path):
     """
     
     # eliminate patients whose health record is void
-    recorded_patients = _get_patients_with_records(tuple_path)
     patients = patients.loc[patients['subject_id'].isin(recorded_patients), :]
     
     patients = patients.loc[:, ['subject_id','gender','age','ethnicity','marital_status', 
@@ -67,55 +86,192 @@ def generate_patient_dict(tuple_path, out_path):
     
     # add icu stay info of patients
     patients = _add_icu_info(patients)
+    
+    # add event counts and first/last event time of patients
+    if events is not None:
+        patients = patients.join(events, 'subject_id', how='left')
+        patients['event_count'] = patients['event_count'].fillna(0).astype(np.int64)
+    
+    # add the reference time of time offsets
+    if TIME_ENCODING is not None:
+        first_event = pd.to_datetime(generate_tuples._first_event_references(), unit='s')
+        patients['reference_time'] = patients['in_time'].fillna(patients['subject_id'].map(first_event))
 
     print('patients_dict.csv shape', patients.shape)
     patients.to_csv(out_path, index=False)
 
 
-def _get_patients_with_records(tuple_path):
+def generate_admission_dict(recorded_patients, out_path):
     '''
-    Find Patients with records in tuples.csv
-    and return IDs of these patients.
+    Generate a dictionary of admissions, whose admission time (in_time) is the
+    reference of time offsets if TIME_ENCODING is 'admission' (see settings.py).
+    
+    Parameters:
+    ----
+        recorded_patients:
+            IDs of patients with records in tuples.csv
+        out_path:
+            filepath to output the dictionary
+            
+    Returns:
+    ----
+        None
+    '''
+    
+    admissions = cohort.read_csv(MIMIC_DIR + 'core/admissions.csv', usecols=['subject_id', 'hadm_id', 'admittime', 'dischtime'],
+                dtype={'subject_id':'str', 'hadm_id':'str'}, index_col=False)
+    admissions = admissions.loc[admissions['subject_id'].isin(recorded_patients), :]
+    admissions.rename({'admittime':'in_time', 'dischtime':'out_time'}, axis=1, inplace=True)
+    
+    admissions = admissions.loc[:, ['subject_id', 'hadm_id', 'in_time', 'out_time']]
+    print('admissions_dict.csv shape', admissions.shape)
+    admissions.to_csv(out_path, index=False)
+
+
+def _count_patient_events(count_dir):
+    '''
+    Aggregate the per-patient statistics (.pst) written by generate_tuples.
+    
+    Parameters:
+    ----
+        count_dir:
+            directory of the .pst files
+            
+    Returns:
+    ----
+        A table indexed by patient ID with columns event_count, 
+        first_event_time and last_event_time
+    '''
+    
+    paths = sorted(count_dir + i for i in os.listdir(count_dir) if i.endswith('.pst'))
+    print('number of patient statistics:', len(paths))
+    
+    # the event times are absolute whatever the time encoding (see generate_tuples._output_patient_stats),
+    # and are compared as datetimes
+    setting = {'patient_id':str, 'event_count':np.int64}
+    stats = pd.concat([pd.read_csv(path, dtype=setting, index_col=False) for path in paths], ignore_index=True)
+    for col in ['first_event_time', 'last_event_time']:
+        stats[col] = pd.to_datetime(stats[col], format='%Y-%m-%d %H:%M:%S')
+    
+    stats = stats.groupby('patient_id').agg(event_count=('event_count', 'sum'),
+                first_event_time=('first_event_time', 'min'), last_event_time=('last_event_time', 'max'))
+    stats.index.name = 'subject_id'
+    return stats
+
+
+def scan_tuples(tuple_path, n_jobs=None, block_size=1 << 24):
+    '''
+    Scan tuples.csv once and collect the patients with records together with
+    the total and numeric-value frequency of each code.
+    The file is split into byte ranges which are scanned in parallel.
     
     Parameters:
     ----
         tuple_path:
-            filepath of tuples.txt
+            filepath of tuples.csv
+        n_jobs:
+            number of processes (default: number of CPUs), at most MAX_SCAN_JOBS
+        block_size:
+            number of bytes parsed at a time by each process (the parsed block
+            takes about 20 times as much memory)
             
     Returns:
     ----
-        IDs of Patients with records
+        patients:
+            IDs of Patients with records
+        counter:
+            A table indexed by code with columns total_frequency and value_frequency
     '''
     
     print('===================================')
-    print('Find patients with health record (tuples).')
+    print('Scan tuples in', tuple_path)
+    
+    n_jobs = min(n_jobs or os.cpu_count(), MAX_SCAN_JOBS)
+    tuple_path = stream_io.resolve(tuple_path)
+    
+    if stream_io.is_compressed(tuple_path):
+        # a compressed file cannot be split, so it is scanned by one process
+        tasks = [(tuple_path, 0, sys.maxsize, block_size)]
+    else:
+        size = os.path.getsize(tuple_path)
+        bounds = np.linspace(0, size, n_jobs + 1).astype(np.int64)
+        tasks = [(tuple_path, bounds[i], bounds[i+1], block_size) for i in range(n_jobs) if bounds[i] < bounds[i+1]]
+    
+    if len(tasks) > 1:
+        with multiprocessing.Pool(len(tasks)) as pool:
+            results = pool.map(_scan_range, tasks)
+    else:
+        # an empty file has no task
+        results = [_scan_range(task) for task in tasks]
     
     patients = set()
+    for p, _ in results:
+        patients.update(p)
     
-    with pd.read_csv(tuple_path, index_col=False, usecols=[0],
-            chunksize=30000000, dtype='str') as reader:
-        for i, chunk in enumerate(reader):
-            for pid in tqdm(chunk.itertuples(False), total=chunk.shape[0]):     
-                patients.add(pid[0])
-        
+    counter = pd.concat([c for _, c in results]).groupby(level=0).sum() if len(results) else \
+        pd.DataFrame(columns=['total_frequency', 'value_frequency'], dtype=np.int64)
+    counter.index.name = 'code'
     
     print('total patients', len(patients))
     print('===================================')
 
-    return patients
+    return patients, counter
 
 
-def revise_code_dict(input_dict_path, tuple_path, output_dict_path, add_label=False):
+def _scan_range(args):
     '''
-    Revise the frequencies in dictionary according to
-    the tuples.txt (namely re-count the frequencies of all codes).
+    Scan the lines of tuples.csv starting within the byte range [start, end).
+    Called by function scan_tuples().
+    '''
+    
+    tuple_path, start, end, block_size = args
+    
+    patients = set()
+    counters = []
+    cols = ['patient_id', 'admission_id', 'time', 'code', 'value']
+    
+    with stream_io.open_reader(tuple_path) as f:
+        # skip the header, or the line owned by the previous range
+        if start == 0:
+            f.readline()
+        else:
+            f.seek(start - 1)
+            f.readline()
+        
+        while f.tell() < end:
+            data = f.read(min(block_size, end - f.tell()))
+            if len(data) == 0:
+                break
+            if not data.endswith(b'\n'):
+                data += f.readline()
+            
+            chunk = pd.read_csv(io.BytesIO(data), header=None, names=cols, index_col=False,
+                                dtype='str', quoting=3)
+            
+            patients.update(chunk['patient_id'].unique())
+            is_value = pd.to_numeric(chunk['value'], errors='coerce').notna()
+            counter = chunk['code'].value_counts().to_frame('total_frequency')
+            counter['value_frequency'] = chunk.loc[is_value, 'code'].value_counts()
+            counters.append(counter.fillna(0).astype(np.int64))
+    
+    if len(counters) == 0:
+        return patients, pd.DataFrame(columns=['total_frequency', 'value_frequency'], dtype=np.int64)
+    
+    return patients, pd.concat(counters).groupby(level=0).sum()
+
+
+def revise_code_dict(input_dict_path, counter, output_dict_path, add_label=False):
+    '''
+    Revise the frequencies in dictionary according to the tuples
+    (namely re-count the frequencies of all codes).
     
     Parameters:
     ----
         input_dict_path:
             filepath of original dictionary
-        tuple_path:
-            filepath of tuples.txt
+        counter:
+            code frequencies, either a table returned by scan_tuples or
+            the directory of the .cnt counters written by generate_tuples
         output_dict_path:
             filepath of updated dictionary
         add_label:
@@ -128,53 +284,59 @@ def revise_code_dict(input_dict_path, tuple_path, output_dict_path, add_label=Fa
     
     print("Revising the dictionary...")
     
-    # load the original dictionary
-    original_dict = pd.read_csv(input_dict_path, 
-        usecols=['code', 'code_type', 'value_frequency', 'total_frequency'], index_col=False)
-
-    original_dict = {i[1]+'_'+i[0]:(i[2], i[3]) for i in original_dict.itertuples(False)}
-    value_freq_dict = {i:0 for i in original_dict}
-    total_freq_dict = {i:0 for i in original_dict}
-
+    with stream_io.open_reader(input_dict_path) as f:
+        new_dict = pd.read_csv(f, dtype={'code':str, 'code_type':str}, index_col=False)
+    tokens = new_dict['code_type'] + '_' + new_dict['code']
+    
     # count the frequency of codes
-    with pd.read_csv(tuple_path, index_col=False,
-            chunksize=30000000, dtype='str') as reader:
-        for i, chunk in enumerate(reader):
-            for pid, hadm, time, code, value in tqdm(chunk.itertuples(False), total=chunk.shape[0]):     
+    if isinstance(counter, str):
+        counter = _count_codes(counter)
+    value_freq = tokens.map(counter['value_frequency']).fillna(0).astype(np.int64)
+    total_freq = tokens.map(counter['total_frequency']).fillna(0).astype(np.int64)
     
-                total_freq_dict[code] += 1
-                
-                def isFloatNum(str):
-                    try:
-                        float(str)
-                    except:
-                        return False
-                    else:
-                        return True
-
-                if not pd.isna(value) and isFloatNum(value):
-                    value_freq_dict[code] += 1
-
-
     # print updated codes
     print('checking freq...')
-    for k,v in original_dict.items():
-        if v[0] != value_freq_dict[k]:
-            print('[Value freq changed] index:', k, ' freq:', v[0], '->', value_freq_dict[k])
-        if v[1] != total_freq_dict[k]:
-            print('[Total freq changed] index:', k, ' freq:', v[1], '->', total_freq_dict[k])
-        
-    new_dict = pd.read_csv(input_dict_path, index_col=False)
-
-    new_dict['value_frequency'] = new_dict[['code_type', 'code']].apply(lambda x:value_freq_dict[x[0]+'_'+x[1]], axis=1)
-    new_dict['total_frequency'] = new_dict[['code_type', 'code']].apply(lambda x:total_freq_dict[x[0]+'_'+x[1]], axis=1)
+    changed = new_dict['value_frequency'] != value_freq
+    for k, old, new in zip(tokens[changed], new_dict.loc[changed, 'value_frequency'], value_freq[changed]):
+        print('[Value freq changed] index:', k, ' freq:', old, '->', new)
+    
+    changed = new_dict['total_frequency'] != total_freq
+    for k, old, new in zip(tokens[changed], new_dict.loc[changed, 'total_frequency'], total_freq[changed]):
+        print('[Total freq changed] index:', k, ' freq:', old, '->', new)
+    
+    new_dict['value_frequency'] = value_freq
+    new_dict['total_frequency'] = total_freq
 
     # add labels to the codes in new dictionary
     if add_label:
         _add_label(new_dict)
     
     # output dictionary
-    new_dict.to_csv(output_dict_path, index=False)
+    with stream_io.open_writer(output_dict_path, text=True) as f:
+        new_dict.to_csv(f, index=False)
+
+
+def _count_codes(count_dir):
+    '''
+    Aggregate the code counters (.cnt) written by generate_tuples.
+    
+    Parameters:
+    ----
+        count_dir:
+            directory of the .cnt counters
+            
+    Returns:
+    ----
+        A table indexed by code with columns total_frequency and value_frequency
+    '''
+    
+    paths = sorted(count_dir + i for i in os.listdir(count_dir) if i.endswith('.cnt'))
+    print('number of counters:', len(paths))
+    
+    setting = {'code':str, 'total_frequency':np.int64, 'value_frequency':np.int64}
+    counter = pd.concat([pd.read_csv(path, dtype=setting, keep_default_na=False, index_col=False) for path in paths],
+                        ignore_index=True)
+    return counter.groupby('code').sum()
 
 
 def _add_label(dic):
@@ -358,13 +520,14 @@ def _add_icu_info(patients: pd.DataFrame):
     
     print('================================')
     print('Add ICU stay info to patients.csv')
-    icu_stay = pd.read_csv(MIMIC_DIR + 'icu/icustays.csv', dtype={'subject_id':'str'}, index_col=False)
+    icu_stay = cohort.read_csv(MIMIC_DIR + 'icu/icustays.csv', usecols=['subject_id','los'],
+                dtype={'subject_id':'str', 'los':np.float64}, index_col=False)
     
     print('icustays.csv shape', icu_stay.shape)
     
     # print((icu_stay['los'] <= 0).value_counts())
     
-    icu_stay = icu_stay.loc[:,['subject_id','los']].groupby('subject_id').sum()
+    icu_stay = icu_stay.groupby('subject_id').sum()
     print('Number of patients once in ICU:', icu_stay.shape)
     
     patients = patients.join(icu_stay, 'subject_id', how='left')
@@ -396,7 +559,8 @@ def add_dict_category(input_dict_path, output_dict_path):
     print("Adding categories the dictionary...")
     
     # load the original dictionary
-    dictionary = pd.read_csv(input_dict_path, dtype='str', index_col=False)
+    with stream_io.open_reader(input_dict_path) as f:
+        dictionary = pd.read_csv(f, dtype='str', index_col=False)
     
     # get categories
     code_set = set(dictionary['code'])
@@ -464,14 +628,51 @@ def _ingredient_level():
 
 
 def main(args):
-    generate_patient_dict(RESULT_ROOT_DIR + 'tuples.csv', RESULT_ROOT_DIR + 'patients_dict.csv')
-    
-    revise_code_dict(IDX_DIR + 'code_dict.csv', RESULT_ROOT_DIR + 'tuples.csv', 
+    # use the statistics from the tuple stage, or scan tuples.csv if they are not available
+    if any(i.endswith('.pst') for i in os.listdir(TUPLE_DIR)):
+        events = _count_patient_events(TUPLE_DIR)
+        recorded_patients = set(events.index[events['event_count'] > 0])
+        counter = TUPLE_DIR
+    else:
+        events = None
+        recorded_patients, counter = scan_tuples(RESULT_ROOT_DIR + 'tuples.csv', args.n_jobs)
+    
+    generate_patient_dict(recorded_patients, RESULT_ROOT_DIR + 'patients_dict.csv', events)
+    
+    # the reference times of admission-relative time offsets
+    if TIME_ENCODING == 'admission':
+        generate_admission_dict(recorded_patients, RESULT_ROOT_DIR + 'admissions_dict.csv')
+    
+    revise_code_dict(IDX_DIR + 'code_dict.csv', counter, 
                      RESULT_ROOT_DIR + 'code_dict.csv', add_label=args.add_label)
     
     if args.add_category:
         add_dict_category(RESULT_ROOT_DIR + 'code_dict.csv', RESULT_ROOT_DIR + 'code_dict_cat.csv')
     
+    if args.int_tuples:
+        tuple_codec.encode_tuples(RESULT_ROOT_DIR + 'tuples.csv', RESULT_ROOT_DIR + 'code_dict.csv',
+                                  RESULT_ROOT_DIR + 'tuples_int.csv')
+    
+    if args.postings:
+        postings.build_postings(RESULT_ROOT_DIR + 'tuples.csv')
+    
+    if args.columnar:
+        columnar_store.build_store(RESULT_ROOT_DIR + 'tuples.csv', RESULT_ROOT_DIR + 'code_dict.csv',
+                                   RESULT_ROOT_DIR + 'columnar/')
+        columnar_store.build_store(RESULT_ROOT_DIR + 'string_tuples.csv', RESULT_ROOT_DIR + 'code_dict.csv',
+                                   RESULT_ROOT_DIR + 'string_columnar/', value_ids=True)
+    
+    if args.sqlite:
+        sqlite_export.export_sqlite(RESULT_ROOT_DIR + 'mimic.sqlite')
+    
+    if args.arrow:
+        arrow_export.export_results(tri=args.arrow_tri)
+    
+    if args.normalize is not None:
+        value_norm.fit_value_stats(RESULT_ROOT_DIR + 'tuples.csv', RESULT_ROOT_DIR + 'code_dict.csv', args.n_bins)
+        value_norm.normalize_tuples(RESULT_ROOT_DIR + 'tuples.csv', value_norm.stats_path(RESULT_ROOT_DIR + 'code_dict.csv'),
+                                    RESULT_ROOT_DIR + 'tuples_{}.csv'.format(args.normalize), args.normalize)
+    
 
 if __name__=='__main__':
     main()
@@ -0,0 +1,173 @@
+import sys
+import os
+import functools
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from settings import RESULT_ROOT_DIR
+import stream_io
+
+
+'''
+Inverted index of tuples: for each code, the sorted list of patients with
+the code, the number of occurrences, and the minimum/maximum numeric value
+of the code for each patient.
+
+The index is saved in <name>_postings.npz, with patient IDs delta-encoded
+within each posting list and compressed.
+
+Example (patients with phecode 250.2 and lab 50912 above 1.5):
+    postings = load_postings(RESULT_ROOT_DIR + 'tuples.csv')
+    cohort = intersect(get_posting(postings, 'phecode_250.2'),
+                       get_posting(postings, 'mimic_50912', above=1.5))
+'''
+
+
+def postings_path(tuple_path):
+    '''
+    filepath of the postings of a tuple file (e.g. tuples.csv -> tuples_postings.npz)
+    '''
+
+    return os.path.splitext(stream_io.strip_ext(tuple_path))[0] + '_postings.npz'
+
+
+def build_postings(tuple_path, chunksize=20000000):
+    '''
+    Build the postings of a tuple file with one pass.
+
+    Parameters:
+    ----
+        tuple_path:
+            filepath of tuples.csv
+        chunksize:
+            number of tuples read at a time
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('Building postings of', tuple_path)
+
+    parts = []
+    with stream_io.open_reader(tuple_path) as f, pd.read_csv(f, usecols=['patient_id', 'code', 'value'],
+            dtype=str, keep_default_na=False, index_col=False, chunksize=chunksize) as reader:
+        for chunk in tqdm(reader):
+            table = pd.DataFrame({'code': chunk['code'].values,
+                                  'patient': chunk['patient_id'].values.astype(np.int64),
+                                  'value': pd.to_numeric(chunk['value'], errors='coerce').values})
+            parts.append(table.groupby(['code', 'patient'])['value'].agg(['size', 'min', 'max']))
+
+    # a patient may be split between two chunks
+    if len(parts) == 0:
+        table = pd.DataFrame({'size': [], 'min': [], 'max': []},
+                             index=pd.MultiIndex.from_arrays([[], []], names=['code', 'patient']))
+    else:
+        table = pd.concat(parts)
+        if len(parts) > 1:
+            table = table.groupby(level=['code', 'patient']).agg({'size':'sum', 'min':'min', 'max':'max'})
+
+    codes = np.asarray(table.index.get_level_values('code'), dtype=str)
+    patients = table.index.get_level_values('patient').values.astype(np.int64)
+
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if codes.shape[0] else np.zeros(0, np.int64)
+    offsets = np.append(starts, codes.shape[0]).astype(np.int64)
+
+    # delta encoding of patient IDs in each posting list
+    deltas = np.diff(patients, prepend=0)
+    deltas[starts] = patients[starts]
+
+    np.savez_compressed(postings_path(tuple_path),
+                        codes=codes[starts], offsets=offsets, deltas=deltas.astype(np.uint32),
+                        counts=table['size'].values.astype(np.uint32),
+                        min_value=table['min'].values.astype(np.float32),
+                        max_value=table['max'].values.astype(np.float32))
+
+    print('codes:', starts.shape[0], 'postings:', codes.shape[0])
+
+
+def load_postings(tuple_path):
+    '''
+    Load the postings of a tuple file.
+
+    Returns:
+    ----
+        A dictionary of numpy arrays:
+            codes:      the codes (sorted), the postings of codes[i] are rows offsets[i]:offsets[i+1]
+            offsets:    int64
+            patients:   int64 patient IDs, sorted in each posting list
+            counts:     number of occurrences of the code
+            min_value, max_value:
+                        minimum/maximum numeric value of the code (NaN if the code has no numeric value)
+    '''
+
+    with np.load(postings_path(tuple_path)) as data:
+        postings = {k:data[k] for k in ['codes', 'offsets', 'counts', 'min_value', 'max_value']}
+        deltas = data['deltas'].astype(np.int64)
+
+    # decode the patient IDs of each posting list
+    starts = postings['offsets'][:-1]
+    cum = np.cumsum(deltas)
+    base = cum[starts] - deltas[starts]
+    postings['patients'] = cum - np.repeat(base, np.diff(postings['offsets']))
+    return postings
+
+
+def get_posting(postings, code, min_count=1, above=None, below=None):
+    '''
+    The patients with a code.
+
+    Parameters:
+    ----
+        postings:
+            the postings returned by load_postings
+        code:
+            the code, e.g. "mimic_50912"
+        min_count:
+            minimum number of occurrences of the code
+        above:
+            if given, only patients with a value of the code greater than it
+        below:
+            if given, only patients with a value of the code less than it
+
+    Returns:
+    ----
+        sorted array of patient IDs
+    '''
+
+    i = np.searchsorted(postings['codes'], code)
+    if i == postings['codes'].shape[0] or postings['codes'][i] != code:
+        return np.zeros(0, dtype=np.int64)
+
+    rows = slice(postings['offsets'][i], postings['offsets'][i + 1])
+    selected = postings['counts'][rows] >= min_count
+    if above is not None:
+        selected &= postings['max_value'][rows] > above
+    if below is not None:
+        selected &= postings['min_value'][rows] < below
+
+    return postings['patients'][rows][selected]
+
+
+def intersect(*patient_lists):
+    '''
+    Patients in all lists (AND)
+    '''
+
+    return functools.reduce(lambda a, b:np.intersect1d(a, b, assume_unique=True), patient_lists)
+
+
+def union(*patient_lists):
+    '''
+    Patients in any list (OR)
+    '''
+
+    return functools.reduce(np.union1d, patient_lists)
+
+
+def main():
+    build_postings(RESULT_ROOT_DIR + 'tuples.csv')
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,181 @@
+import sys
+import os
+import io
+import numpy as np
+import pandas as pd
+from settings import RESULT_ROOT_DIR, TIME_ENCODING, TIME_UNIT
+import tuple_index
+import postings
+import stream_io
+
+
+'''
+Queries of tuples by (patient set, code set, time range).
+
+Only the blocks of the selected patients are read (see tuple_index; with
+codes but no patients, the postings narrow the patients if they exist), and
+as the tuples of a patient are ordered by time, the time range is found
+by binary search in the block of each patient. With TIME_ENCODING =
+'admission', the offsets restart at each admission and are not ordered in a
+block, so the time range is found by a scan of the block instead.
+
+Example:
+    # all values of lab 50912 of two patients in January 2150
+    query(patients=[10000032, 10000084], codes=['mimic_50912'],
+          start='2150-01-01', end='2150-02-01')
+
+    # everything in the 48 hours after the first admission of each patient
+    start, end = windows_after_admission(48)
+    query(start=start, end=end)
+'''
+
+
+def query(tuple_path=RESULT_ROOT_DIR + 'tuples.csv', patients=None, codes=None, start=None, end=None,
+          as_arrays=False):
+    '''
+    Select the tuples of patients with given codes in a time range [start, end).
+
+    Parameters:
+    ----
+        tuple_path:
+            filepath of tuples.csv (or string_tuples.csv, whose values are value IDs:
+            see tuple_codec.decode_string_values), which must have its index (see tuple_index)
+        patients:
+            IDs of the patients (default: all patients)
+        codes:
+            codes such as "mimic_50912" (default: all codes)
+        start, end:
+            bounds of the time range (default: unbounded). A bound is a time (str or pandas.Timestamp),
+            or an integer offset if the tuples have relative time (see TIME_ENCODING in settings.py).
+            A pandas.Series indexed by patient ID gives a bound for each patient (NaN: unbounded).
+            Tuples without time are only selected if end is unbounded.
+        as_arrays:
+            whether return a dictionary of numpy arrays instead of a table
+
+    Returns:
+    ----
+        A table (or a dictionary of numpy arrays) of tuples, ordered by patient ID and time
+    '''
+
+    index = tuple_index.load_index(tuple_path)
+    if patients is None:
+        patients = index['patient_id']
+
+        # only read the patients with the codes if the postings exist
+        if codes is not None and os.path.exists(postings.postings_path(tuple_path)):
+            index_postings = postings.load_postings(tuple_path)
+            patients = postings.union(np.zeros(0, np.int64), *[postings.get_posting(index_postings, str(i)) for i in codes])
+    if codes is not None:
+        codes = set(str(i).encode('utf8') for i in codes)
+
+    data = []
+    with stream_io.open_reader(tuple_path) as f:
+        for patient_id, block in tuple_index.iter_patient_blocks(f, index, patients):
+            lines = block.split(b'\n')[:-1]
+
+            lower, upper = _bound(start, patient_id), _bound(end, patient_id)
+            if TIME_ENCODING == 'admission':
+                lines = _filter(lines, lower, upper)
+            else:
+                lo = _search(lines, lower, 0)
+                hi = _search(lines, upper, len(lines))
+                lines = lines[lo:hi]
+
+            if codes is not None:
+                lines = [l for l in lines if l.split(b',', 4)[3] in codes]
+
+            data.extend(lines)
+
+    table = _parse(data)
+    if as_arrays:
+        return {k:table[k].values for k in table.columns}
+    return table
+
+
+def windows_after_admission(hours, patients_dict_path=RESULT_ROOT_DIR + 'patients_dict.csv'):
+    '''
+    The time range of the given hours after admission, as (start, end) for function query().
+    With absolute time, the range starts at the first admission (in_time) of each patient.
+    With relative time, the range starts at the reference time (offset 0), which is the
+    admission of each tuple with TIME_ENCODING = 'admission'.
+    '''
+
+    if TIME_ENCODING is not None:
+        return 0, int(hours * 3600 // TIME_UNIT)
+
+    patients = pd.read_csv(patients_dict_path, usecols=['subject_id', 'in_time'], dtype={'subject_id':np.int64},
+                           parse_dates=['in_time'], index_col='subject_id')
+    start = patients['in_time'].dropna()
+    return start, start + pd.Timedelta(hours=hours)
+
+
+def _bound(bound, patient_id):
+    '''
+    The key of a bound of the time range for a patient, None if unbounded
+    '''
+
+    if bound is None:
+        return None
+
+    if isinstance(bound, pd.Series):
+        bound = bound.get(patient_id)
+        if bound is None or pd.isna(bound):
+            return None
+
+    if isinstance(bound, (int, float, np.number)):
+        return int(np.ceil(bound))
+    return pd.Timestamp(bound).strftime('%Y-%m-%d %H:%M:%S').encode('utf8')
+
+
+def _time_key(line, bound):
+    '''
+    The time of a line, comparable with the bound (tuples without time are the last)
+    '''
+
+    time = line.split(b',', 3)[2]
+    if isinstance(bound, int):
+        return int(time) if time != b'' else float('inf')
+    return time
+
+
+def _search(lines, bound, default):
+    '''
+    The first line whose time is not less than the bound (binary search),
+    or default if unbounded
+    '''
+
+    if bound is None:
+        return default
+
+    lo, hi = 0, len(lines)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _time_key(lines[mid], bound) < bound:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _filter(lines, lower, upper):
+    '''
+    The lines whose time is in [lower, upper) (None: unbounded), for lines not ordered by time
+    '''
+
+    if lower is not None:
+        lines = [l for l in lines if _time_key(l, lower) >= lower]
+    if upper is not None:
+        lines = [l for l in lines if _time_key(l, upper) < upper]
+    return lines
+
+
+def _parse(lines):
+    '''
+    Parse lines of tuples
+    '''
+
+    if len(lines) == 0:
+        return pd.DataFrame({i:pd.Series(dtype=object) for i in tuple_index.cols})
+
+    return pd.read_csv(io.BytesIO(b'\n'.join(lines) + b'\n'), header=None, names=tuple_index.cols, index_col=False,
+                       dtype='str', keep_default_na=False, quoting=3)
@@ -2,12 +2,43 @@
 Settings of cleaning
 '''
 
+import os
+
 MIMIC_DIR = 'MIMIC-IV_Data_Preperation_V1.0/Raw_MIMIC-IV/'    # save MIMIC-IV v1.0 original finals downloaded from https://physionet.org/content/mimiciv/1.0/
 ROLL_UP_SRC = 'MIMIC-IV_Data_Preperation_V1.0/rollup_tables/'   # files of roll-up tables
 UOM_SRC  = 'MIMIC-IV_Data_Preperation_V1.0/uom_dependency/'   # files of roll-up tables
 RESULT_ROOT_DIR = 'MIMIC-IV_Data_Preperation_V1.0/Cleaned_MIMIC-IV/'    # the directory to output the result
 
+# sharding (see shard_mimic.py): the raw tables can be split by subject_id into shards under SHARD_ROOT_DIR,
+# a run with the environment variable MIMIC_SHARD=<i> reads and writes the files of shard i only
+SHARD_ROOT_DIR = RESULT_ROOT_DIR + 'shards/'
+SHARD = os.environ.get('MIMIC_SHARD')
+if SHARD is not None:
+    MIMIC_DIR = SHARD_ROOT_DIR + 'shard{}/raw/'.format(SHARD)
+    RESULT_ROOT_DIR = SHARD_ROOT_DIR + 'shard{}/'.format(SHARD)
+
+# cohort (see cohort.py): file of subject_ids (one per line) to restrict the run to, None for all subjects
+COHORT = os.environ.get('MIMIC_COHORT')
+
 # the following files are under RESULT_ROOT_DIR
 TUPLE_DIR = RESULT_ROOT_DIR + 'tuple/'
 STRING_TUPLE_DIR = RESULT_ROOT_DIR + 'string_tuple/'
 IDX_DIR = RESULT_ROOT_DIR + 'index/'
+
+# compression of tuples, .tri files and code_dict.csv: None, 'gzip' or 'zstd' (needs the zstandard package)
+COMPRESSION = None
+
+# time of tuples: None (absolute time, e.g. "2150-01-01 00:00:00"), or an integer offset from a reference time:
+# 'patient' (the first admission time of the patient, in_time of patients_dict.csv) or
+# 'admission' (admittime of the admission of the tuple, in_time if the tuple has no admission);
+# for patients without admission, their first event time in all tables. The reference of each
+# patient is reference_time of patients_dict.csv.
+TIME_ENCODING = None
+TIME_UNIT = 60  # seconds per unit of time offsets (1: seconds, 60: minutes)
+
+# aggregation of the numeric values of high-frequency tables: None (keep all values), or the size of time buckets
+# as a pandas frequency (e.g. '1h'). The numeric values of a code of a patient in a bucket are replaced by one
+# tuple at the beginning of the bucket, with their aggregate: 'mean', 'median', 'min', 'max', 'first' or 'last'
+VALUE_BUCKET = None
+VALUE_BUCKET_AGG = 'mean'
+VALUE_BUCKET_TABLES = ['chartevents']
@@ -0,0 +1,243 @@
+import sys
+import os
+import json
+import shutil
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from settings import RESULT_ROOT_DIR, TUPLE_DIR, STRING_TUPLE_DIR, IDX_DIR, MIMIC_DIR, SHARD_ROOT_DIR, SHARD
+import generate_dictionary
+import generate_tuples
+import post_process
+import stream_io
+
+
+'''
+Sharded cleaning: the raw tables are hash-partitioned by subject_id into
+shards, and the dictionary counting, tuple generation and merging run on
+each shard independently (in separate processes, or on separate hosts
+sharing the file system). Only the code counts of the shards are reduced.
+
+Steps (a shard step runs with the environment variable MIMIC_SHARD=<i>):
+    python shard_mimic.py split --n_shards N
+    MIMIC_SHARD=i python shard_mimic.py dict        (for each shard)
+    python shard_mimic.py reduce_dict
+    MIMIC_SHARD=i python shard_mimic.py tuples      (for each shard)
+    python shard_mimic.py reduce
+or all of them on this machine, with a process per shard:
+    python shard_mimic.py run --n_shards N
+
+The tuples (and the string value vocabulary) of shard i are in SHARD_ROOT_DIR/shard<i>/,
+code_dict.csv and patients_dict.csv of all shards are in RESULT_ROOT_DIR.
+'''
+
+
+def shard_of(subject_ids, n_shards):
+    '''
+    The shard of each subject_id (a stable hash of the ID modulo the number of shards)
+    '''
+
+    ids = np.asarray(subject_ids, dtype=np.int64)
+    return (pd.util.hash_array(ids) % np.uint64(n_shards)).astype(np.int64)
+
+
+def shard_dir(i):
+    '''
+    The result directory of shard i (RESULT_ROOT_DIR of a run with MIMIC_SHARD=i)
+    '''
+
+    return SHARD_ROOT_DIR + 'shard{}/'.format(i)
+
+
+def _shard_path(i, path):
+    '''
+    Map a path under RESULT_ROOT_DIR to the same path under the directory of shard i
+    '''
+
+    return shard_dir(i) + path[len(RESULT_ROOT_DIR):]
+
+
+def load_n_shards():
+    with open(SHARD_ROOT_DIR + 'shards.json', 'r', encoding='utf8') as f:
+        return json.load(f)['n_shards']
+
+
+def split_tables(n_shards, chunksize=10000000):
+    '''
+    Hash-partition all raw tables with a subject_id column by subject_id.
+    Other tables (e.g. d_items.csv) are linked (or copied) into every shard.
+
+    Parameters:
+    ----
+        n_shards:
+            number of shards
+        chunksize:
+            number of rows read at a time
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('Splitting {} into {} shards'.format(MIMIC_DIR, n_shards))
+
+    for sub_dir in sorted(os.listdir(MIMIC_DIR)):
+        if not os.path.isdir(MIMIC_DIR + sub_dir):
+            continue
+
+        for i in range(n_shards):
+            os.makedirs(shard_dir(i) + 'raw/' + sub_dir, exist_ok=True)
+
+        for name in sorted(os.listdir(MIMIC_DIR + sub_dir)):
+            if not name.endswith('.csv'):
+                continue
+
+            src_path = MIMIC_DIR + sub_dir + '/' + name
+            dst_paths = [shard_dir(i) + 'raw/' + sub_dir + '/' + name for i in range(n_shards)]
+
+            header = pd.read_csv(src_path, nrows=0).columns
+            if 'subject_id' not in header:
+                print('copy', src_path)
+                for dst in dst_paths:
+                    _link_or_copy(src_path, dst)
+                continue
+
+            print('split', src_path)
+            outs = [open(dst, 'w', encoding='utf8', newline='') for dst in dst_paths]
+            
+            # every shard gets the header, even if it has no rows
+            for out in outs:
+                out.write(','.join(header) + '\n')
+            
+            with pd.read_csv(src_path, dtype=str, keep_default_na=False, chunksize=chunksize,
+                    index_col=False) as reader:
+                for chunk in tqdm(reader):
+                    shards = shard_of(chunk['subject_id'], n_shards)
+                    for i, part in chunk.groupby(shards):
+                        part.to_csv(outs[i], index=False, header=False)
+            
+            for out in outs:
+                out.close()
+
+    with open(SHARD_ROOT_DIR + 'shards.json', 'w', encoding='utf8') as f:
+        json.dump({'n_shards': n_shards}, f)
+
+
+def _link_or_copy(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _make_dirs():
+    for path in [RESULT_ROOT_DIR, TUPLE_DIR, STRING_TUPLE_DIR, IDX_DIR]:
+        os.makedirs(path, exist_ok=True)
+
+
+def count_shard():
+    '''
+    Count the codes of this shard (MIMIC_SHARD must be set)
+    '''
+
+    assert SHARD is not None, 'MIMIC_SHARD is not set'
+    _make_dirs()
+
+    generate_dictionary.main()
+
+
+def reduce_dicts(n_shards):
+    '''
+    Build code_dict.csv from the code counts of all shards,
+    and copy it to the index directory of every shard.
+    '''
+
+    _make_dirs()
+
+    generate_dictionary.reduce_shard_dicts([_shard_path(i, IDX_DIR) for i in range(n_shards)])
+
+    dict_path = stream_io.resolve(IDX_DIR + 'code_dict.csv')
+    for i in range(n_shards):
+        for path in [dict_path, IDX_DIR + 'code_dict.npy']:
+            shutil.copyfile(path, _shard_path(i, path))
+
+
+def generate_shard_tuples(n_jobs=1):
+    '''
+    Generate and merge the tuples of this shard (MIMIC_SHARD must be set),
+    and output the patients_dict.csv of the shard.
+    '''
+
+    assert SHARD is not None, 'MIMIC_SHARD is not set'
+    _make_dirs()
+    generate_tuples.main(n_jobs)
+
+    events = post_process._count_patient_events(TUPLE_DIR)
+    post_process.generate_patient_dict(set(events.index[events['event_count'] > 0]),
+                                       RESULT_ROOT_DIR + 'patients_dict.csv', events)
+
+
+def reduce_shards(n_shards):
+    '''
+    Reduce the code counts of the tuples of all shards into the final code_dict.csv,
+    and concatenate the patients_dict.csv of all shards.
+    '''
+
+    counter = pd.concat([post_process._count_codes(_shard_path(i, TUPLE_DIR)) for i in range(n_shards)])
+    counter = counter.groupby(level=0).sum()
+    post_process.revise_code_dict(IDX_DIR + 'code_dict.csv', counter, RESULT_ROOT_DIR + 'code_dict.csv')
+
+    patients = pd.concat([pd.read_csv(shard_dir(i) + 'patients_dict.csv', dtype=str, keep_default_na=False,
+                                      index_col=False) for i in range(n_shards)], ignore_index=True)
+    patients.sort_values('subject_id', key=lambda x:x.astype(np.int64), kind='mergesort', inplace=True)
+    patients.to_csv(RESULT_ROOT_DIR + 'patients_dict.csv', index=False)
+
+
+def _run_shards(step, n_shards, extra_args=()):
+    '''
+    Run a shard step in a process per shard, and wait for all of them
+    '''
+
+    procs = []
+    for i in range(n_shards):
+        env = dict(os.environ, MIMIC_SHARD=str(i))
+        procs.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), step] + list(extra_args), env=env))
+
+    failed = [i for i, p in enumerate(procs) if p.wait() != 0]
+    if len(failed) != 0:
+        print('step {} failed in shards {}'.format(step, failed))
+        exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Clean MIMIC-IV in shards partitioned by subject_id.')
+    parser.add_argument('step', choices=['split', 'dict', 'reduce_dict', 'tuples', 'reduce', 'run'])
+    parser.add_argument('--n_shards', type=int, default=None, help='number of shards (split and run)')
+    parser.add_argument('--n_jobs', type=int, default=1, help='number of processes used to merge tuples in a shard')
+    args = parser.parse_args()
+
+    if args.step in ['split', 'run']:
+        assert args.n_shards is not None and args.n_shards > 0, '--n_shards is required'
+        split_tables(args.n_shards)
+
+    if args.step == 'dict':
+        count_shard()
+    elif args.step == 'reduce_dict':
+        reduce_dicts(load_n_shards())
+    elif args.step == 'tuples':
+        generate_shard_tuples(args.n_jobs)
+    elif args.step == 'reduce':
+        reduce_shards(load_n_shards())
+    elif args.step == 'run':
+        _run_shards('dict', args.n_shards)
+        reduce_dicts(args.n_shards)
+        _run_shards('tuples', args.n_shards, ['--n_jobs', str(args.n_jobs)])
+        reduce_shards(args.n_shards)
+
+
+if __name__=='__main__':
+    main()
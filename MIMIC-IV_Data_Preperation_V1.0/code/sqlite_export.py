@@ -0,0 +1,206 @@
+import sys
+import os
+import time
+import sqlite3
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from settings import RESULT_ROOT_DIR, TIME_ENCODING
+import stream_io
+
+
+'''
+Export of the cleaned data to a single SQLite file.
+
+Tables:
+    tuples:
+        patient_id INTEGER, admission_id INTEGER, time TEXT (INTEGER if the time is relative),
+        code TEXT, value REAL (NULL if not numeric), value_text TEXT (the value if it is not numeric)
+    string_tuples:
+        patient_id INTEGER, admission_id INTEGER, time TEXT (INTEGER if the time is relative),
+        code TEXT, value_id INTEGER (the ID of the text in string_value_vocab)
+    code_dict, patients_dict, string_value_vocab:
+        the columns of the csv files
+Indexes are created after loading: tuples(patient_id, time), tuples(code, patient_id, value),
+string_tuples(patient_id, time), string_tuples(code, patient_id, value_id) and string_value_vocab(value_id).
+The view string_tuple_texts joins string_tuples with the texts of their values (column value).
+'''
+
+
+# pragmas for bulk loading: the file is rebuilt from scratch if the export fails
+BULK_PRAGMAS = [
+    'PRAGMA page_size = 65536',
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA locking_mode = EXCLUSIVE',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -1048576',
+]
+
+
+def export_sqlite(out_path=RESULT_ROOT_DIR + 'mimic.sqlite', result_dir=RESULT_ROOT_DIR, batch_size=100000):
+    '''
+    Bulk-load the cleaned data into a SQLite file.
+
+    Parameters:
+    ----
+        out_path:
+            filepath of the SQLite file (overwritten)
+        result_dir:
+            directory of tuples.csv, string_tuples.csv, string_value_vocab.csv, code_dict.csv and patients_dict.csv
+        batch_size:
+            number of rows inserted by an executemany call
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('Exporting {} to {}'.format(result_dir, out_path))
+
+    if os.path.exists(out_path):
+        os.remove(out_path)
+
+    conn = sqlite3.connect(out_path, isolation_level=None)
+    for pragma in BULK_PRAGMAS:
+        conn.execute(pragma)
+
+    time_type = 'TEXT' if TIME_ENCODING is None else 'INTEGER'
+    conn.execute('CREATE TABLE tuples (patient_id INTEGER, admission_id INTEGER, time {}, code TEXT, '
+                 'value REAL, value_text TEXT)'.format(time_type))
+    _load_tuples(conn, 'tuples', result_dir + 'tuples.csv', batch_size)
+    conn.execute('CREATE TABLE string_tuples (patient_id INTEGER, admission_id INTEGER, time {}, code TEXT, '
+                 'value_id INTEGER)'.format(time_type))
+    _load_tuples(conn, 'string_tuples', result_dir + 'string_tuples.csv', batch_size)
+
+    for name in ['code_dict', 'patients_dict']:
+        path = stream_io.resolve(result_dir + name + '.csv')
+        if os.path.exists(path):
+            _load_table(conn, name, path, batch_size)
+
+    # the texts of the vocabulary are kept as they are (e.g. "NA" is not NULL)
+    path = stream_io.resolve(result_dir + 'string_value_vocab.csv')
+    if os.path.exists(path):
+        _load_table(conn, 'string_value_vocab', path, batch_size, dtype={'value':str}, keep_default_na=False)
+        conn.execute('CREATE UNIQUE INDEX string_value_vocab_id ON string_value_vocab (value_id)')
+        conn.execute('CREATE VIEW string_tuple_texts AS SELECT t.patient_id, t.admission_id, t.time, t.code, '
+                     't.value_id, v.value FROM string_tuples t LEFT JOIN string_value_vocab v USING (value_id)')
+
+    for name, value in [('tuples', 'value'), ('string_tuples', 'value_id')]:
+        start = time.time()
+        conn.execute('CREATE INDEX {0}_patient_time ON {0} (patient_id, time)'.format(name))
+        conn.execute('CREATE INDEX {0}_code_patient ON {0} (code, patient_id, {1})'.format(name, value))
+        print('[{}] indexes created in {:.1f}s'.format(name, time.time() - start))
+
+    conn.execute('ANALYZE')
+    conn.close()
+
+    print('SQLite file size: {:.1f} MB'.format(os.path.getsize(out_path) / 1e6))
+
+
+def _load_tuples(conn, name, path, batch_size, chunksize=5000000):
+    '''
+    Load a tuple file into a table, in a single transaction
+    '''
+
+    path = stream_io.resolve(path)
+    if not os.path.exists(path):
+        print('{} not found, table {} is empty'.format(path, name))
+        return
+
+    start = time.time()
+    n_rows = 0
+    n_columns = len(conn.execute('SELECT * FROM {} LIMIT 0'.format(name)).description)
+    insert = 'INSERT INTO {} VALUES ({})'.format(name, ', '.join('?' * n_columns))
+
+    conn.execute('BEGIN')
+    with stream_io.open_reader(path) as f, pd.read_csv(f, dtype=str, keep_default_na=False, quoting=3,
+            index_col=False, chunksize=chunksize) as reader:
+        for chunk in tqdm(reader):
+            rows = _tuple_rows(chunk) if name == 'tuples' else _string_tuple_rows(chunk)
+            for i in range(0, len(rows), batch_size):
+                conn.executemany(insert, rows[i:i + batch_size])
+            n_rows += len(rows)
+    conn.execute('COMMIT')
+
+    _report(name, path, n_rows, time.time() - start)
+
+
+def _tuple_rows(chunk):
+    '''
+    Convert a chunk of tuples to rows of the tuples table
+    '''
+
+    value = pd.to_numeric(chunk['value'], errors='coerce')
+    value_text = chunk['value'].where(value.isna() & (chunk['value'] != ''))
+
+    table = _key_columns(chunk).assign(value=value, value_text=value_text)
+    return _to_rows(table)
+
+
+def _string_tuple_rows(chunk):
+    '''
+    Convert a chunk of string tuples (whose values are value IDs) to rows of the string_tuples table
+    '''
+
+    table = _key_columns(chunk).assign(value_id=pd.to_numeric(chunk['value'], errors='coerce').astype('Int64'))
+    return _to_rows(table)
+
+
+def _key_columns(chunk):
+    '''
+    The patient, admission, time and code columns of a chunk of tuples
+    '''
+
+    admission = pd.to_numeric(chunk['admission_id'], errors='coerce').astype('Int64')
+    time = chunk['time'] if TIME_ENCODING is None else pd.to_numeric(chunk['time'], errors='coerce').astype('Int64')
+
+    return pd.DataFrame({'patient_id': chunk['patient_id'].astype(np.int64), 'admission_id': admission,
+                         'time': time, 'code': chunk['code']})
+
+
+def _load_table(conn, name, path, batch_size, **kwargs):
+    '''
+    Load a (small) csv file into a table with the types inferred by pandas
+    (keyword arguments are passed to pandas.read_csv)
+    '''
+
+    start = time.time()
+    with stream_io.open_reader(path) as f:
+        table = pd.read_csv(f, index_col=False, **kwargs)
+
+    types = {k:('INTEGER' if pd.api.types.is_integer_dtype(v) else 'REAL' if pd.api.types.is_float_dtype(v) else 'TEXT')
+             for k, v in table.dtypes.items()}
+    conn.execute('CREATE TABLE {} ({})'.format(name, ', '.join('"{}" {}'.format(k, v) for k, v in types.items())))
+
+    rows = _to_rows(table)
+    insert = 'INSERT INTO {} VALUES ({})'.format(name, ', '.join('?' * table.shape[1]))
+    conn.execute('BEGIN')
+    for i in range(0, len(rows), batch_size):
+        conn.executemany(insert, rows[i:i + batch_size])
+    conn.execute('COMMIT')
+
+    _report(name, path, table.shape[0], time.time() - start)
+
+
+def _to_rows(table):
+    '''
+    Rows of a table as python objects, NaN/NA as None
+    '''
+
+    table = table.astype(object).where(table.notna(), None)
+    return list(table.itertuples(index=False, name=None))
+
+
+def _report(name, path, n_rows, elapsed):
+    size = os.path.getsize(path)
+    print('[{}] {} rows, {:.1f} MB loaded in {:.1f}s ({:.0f} rows/s, {:.1f} MB/s)'.format(
+        name, n_rows, size / 1e6, elapsed, n_rows / max(elapsed, 1e-9), size / 1e6 / max(elapsed, 1e-9)))
+
+
+def main():
+    export_sqlite()
+
+
+if __name__=='__main__':
+    main()
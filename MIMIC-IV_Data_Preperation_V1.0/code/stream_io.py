@@ -0,0 +1,272 @@
+import sys
+import os
+import io
+import gzip
+import time
+import queue
+import threading
+from settings import COMPRESSION
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+'''
+Streaming (optionally compressed) file IO.
+
+Output files are written by a background thread, which compresses the data
+(gzip or zstd, see COMPRESSION in settings.py) while the caller keeps producing it.
+Compressed files get the extension .gz or .zst, and open_reader/resolve find them transparently.
+'''
+
+
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def output_compression():
+    '''
+    The compression used for output files (None, 'gzip' or 'zstd').
+    zstd falls back to gzip if the zstandard package (>=0.16) is not installed.
+    '''
+
+    if COMPRESSION == 'zstd' and zstandard is None:
+        return 'gzip'
+    return COMPRESSION
+
+
+def strip_ext(path):
+    '''
+    Remove the compression extension of a filepath
+    '''
+
+    for ext in EXTENSIONS.values():
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+def resolve(path):
+    '''
+    Find the existing file of a filepath (uncompressed or compressed),
+    preferring the compression of output files.
+    '''
+
+    exts = [''] + list(EXTENSIONS.values())
+    exts.sort(key=lambda ext:ext != EXTENSIONS.get(output_compression(), ''))
+    for ext in exts:
+        if os.path.exists(path + ext):
+            return path + ext
+    return path
+
+
+def is_compressed(path):
+    return strip_ext(path) != path
+
+
+class StreamWriter(io.RawIOBase):
+    '''
+    A binary file writer which compresses and writes data in a background thread.
+    tell() returns the number of uncompressed bytes written so far.
+    '''
+
+    def __init__(self, path, compression=None, buffer_size=1 << 20, queue_size=64):
+        self.path = path + EXTENSIONS.get(compression, '')
+        self._raw = open(self.path, 'wb')
+
+        if compression == 'gzip':
+            self._out = gzip.GzipFile(filename='', mode='wb', compresslevel=6, fileobj=self._raw, mtime=0)
+        elif compression == 'zstd':
+            self._out = zstandard.ZstdCompressor(level=3).stream_writer(self._raw)
+        else:
+            self._out = self._raw
+        self._compression = compression
+
+        self._buffer = bytearray()
+        self._buffer_size = buffer_size
+        self._queue = queue.Queue(queue_size)
+        self._size = 0
+        self._error = None
+
+        # time spent by the caller waiting for the writer thread, and by the writer thread
+        self._start = time.time()
+        self._wait = 0.0
+        self._busy = 0.0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+
+            if self._error is None:
+                t = time.time()
+                try:
+                    self._out.write(data)
+                except Exception as e:
+                    self._error = e
+                self._busy += time.time() - t
+
+    def _put(self, data):
+        t = time.time()
+        self._queue.put(data)
+        self._wait += time.time() - t
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+
+        n = len(data)
+        self._buffer += data
+        self._size += n
+
+        if len(self._buffer) >= self._buffer_size:
+            self._put(bytes(self._buffer))
+            self._buffer = bytearray()
+        return n
+
+    def tell(self):
+        return self._size
+
+    def close(self):
+        if self.closed:
+            return
+
+        if len(self._buffer) != 0:
+            self._put(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._put(None)
+        self._thread.join()
+
+        if self._compression == 'zstd':
+            self._out.flush(zstandard.FLUSH_FRAME)
+        if self._out is not self._raw:
+            self._out.close()
+        self._raw.close()
+        super().close()
+
+        if self._error is not None:
+            raise self._error
+
+        self._report()
+
+    def _report(self):
+        elapsed = max(time.time() - self._start, 1e-9)
+        size = os.path.getsize(self.path)
+        print('[{}] {:.1f} MB -> {:.1f} MB (ratio {:.2f}), {:.1f} MB/s, writer busy {:.1f}s, caller blocked {:.1f}s of {:.1f}s'.format(
+            os.path.basename(self.path), self._size / 1e6, size / 1e6, self._size / max(size, 1),
+            self._size / 1e6 / elapsed, self._busy, self._wait, elapsed))
+
+
+class _ZstdReader(io.RawIOBase):
+    '''
+    A zstd file reader which can seek like gzip.GzipFile:
+    by decompressing forward (from the beginning for a backward seek).
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        self._open()
+
+    def _open(self):
+        self._raw = open(self._path, 'rb')
+        self._reader = zstandard.ZstdDecompressor().stream_reader(self._raw, read_across_frames=True)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._reader.readinto(b)
+        self._pos += n
+        return n
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('can only seek from the beginning or the current position')
+
+        if offset < self._pos:
+            self._reader.close()
+            self._raw.close()
+            self._open()
+
+        while self._pos < offset:
+            if len(self.read(min(offset - self._pos, 1 << 20))) == 0:
+                break
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._reader.close()
+            self._raw.close()
+        super().close()
+
+
+def open_writer(path, text=False, compression=output_compression()):
+    '''
+    Open an output file with the threaded streaming writer.
+
+    Parameters:
+    ----
+        path:
+            filepath without the compression extension
+        text:
+            whether return a text (utf8) file object
+        compression:
+            None, 'gzip' or 'zstd' (default: COMPRESSION in settings.py)
+
+    Returns:
+    ----
+        A binary file object (StreamWriter), or a text file object if text is True.
+        The real filepath is StreamWriter.path.
+    '''
+
+    writer = StreamWriter(path, compression)
+    if text:
+        return io.TextIOWrapper(writer, encoding='utf8', newline='')
+    return writer
+
+
+def open_reader(path, text=False):
+    '''
+    Open a (possibly compressed) file for reading.
+
+    Parameters:
+    ----
+        path:
+            filepath, with or without the compression extension
+        text:
+            whether return a text (utf8) file object
+
+    Returns:
+    ----
+        A binary file object, or a text file object if text is True.
+    '''
+
+    path = resolve(path)
+
+    if path.endswith(EXTENSIONS['gzip']):
+        reader = gzip.open(path, 'rb')
+    elif path.endswith(EXTENSIONS['zstd']):
+        reader = io.BufferedReader(_ZstdReader(path))
+    else:
+        reader = open(path, 'rb')
+
+    if text:
+        return io.TextIOWrapper(reader, encoding='utf8')
+    return reader
@@ -0,0 +1,300 @@
+import sys
+import os
+import time
+import json
+import socket
+import argparse
+import threading
+import collections
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import pandas as pd
+from settings import RESULT_ROOT_DIR, MIMIC_DIR
+import tuple_index
+import stream_io
+
+
+'''
+Local server of patient timelines, backed by tuples.csv and its per-patient
+index (see tuple_index), with a size-bounded LRU cache of decoded timelines.
+
+Requests (GET, answers in JSON):
+    /timeline?patient_id=X              the tuples of patient X
+    /timelines?patient_id=X,Y,...       the tuples of many patients (also POST /timelines with a JSON list of IDs)
+    /admission?admission_id=Y           the tuples of admission Y
+    /stats                              latency percentiles (ms) and cache hit rate
+
+A timeline is {"patient_id": X, "admission_id": [...], "time": [...], "code": [...], "value": [...]}.
+
+Example:
+    python timeline_server.py --port 8765 --cache_mb 1024
+    curl 'http://127.0.0.1:8765/timeline?patient_id=10000032'
+or over a UNIX socket:
+    python timeline_server.py --socket /tmp/timelines.sock
+    curl --unix-socket /tmp/timelines.sock 'http://localhost/stats'
+'''
+
+
+class TimelineStore:
+    '''
+    Timelines of patients with an LRU cache, whose size is measured by
+    the memory of the decoded timelines (see _timeline_size).
+    Unknown patients are not cached.
+    '''
+
+    def __init__(self, tuple_path=RESULT_ROOT_DIR + 'tuples.csv', cache_bytes=1 << 30, n_latencies=100000):
+        self.tuple_path = tuple_path
+        self.index = tuple_index.load_index(tuple_path)
+        self.cache_bytes = cache_bytes
+
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.latencies = collections.deque(maxlen=n_latencies)
+
+        self.lock = threading.Lock()
+        self.file = stream_io.open_reader(tuple_path)
+        self.file_lock = threading.Lock()
+        self.admissions = None
+
+    def timelines(self, patient_ids):
+        '''
+        The timelines of patients (empty timelines for unknown patients), in the given order
+        '''
+
+        patient_ids = [int(i) for i in patient_ids]
+        found = {}
+        with self.lock:
+            for i in patient_ids:
+                if i in self.cache:
+                    self.cache.move_to_end(i)
+                    found[i] = self.cache[i][0]
+                    self.hits += 1
+            self.misses += len(set(patient_ids) - set(found))
+
+        missing = sorted(set(patient_ids) - set(found))
+        if len(missing) != 0:
+            with self.file_lock:
+                blocks = dict(tuple_index.iter_patient_blocks(self.file, self.index, missing))
+
+            with self.lock:
+                for i in missing:
+                    found[i] = _decode(i, blocks.get(i, b''))
+                    if i in blocks:
+                        self._insert(i, found[i], _timeline_size(found[i]))
+
+        return [found[i] for i in patient_ids]
+
+    def admission(self, admission_id):
+        '''
+        The tuples of an admission
+        '''
+
+        admission_id = str(admission_id)
+        with self.lock:
+            # loaded at the first request of an admission
+            if self.admissions is None:
+                self.admissions = _load_admissions()
+            patient_id = self.admissions.get(admission_id)
+        if patient_id is None:
+            return {'admission_id': admission_id, 'patient_id': None, 'time': [], 'code': [], 'value': []}
+
+        timeline = self.timelines([patient_id])[0]
+        rows = [k for k, v in enumerate(timeline['admission_id']) if v == admission_id]
+        return {'admission_id': admission_id, 'patient_id': patient_id,
+                'time': [timeline['time'][k] for k in rows],
+                'code': [timeline['code'][k] for k in rows],
+                'value': [timeline['value'][k] for k in rows]}
+
+    def stats(self):
+        '''
+        Latency percentiles (ms) of the recent requests and the cache hit rate
+        '''
+
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            n = self.hits + self.misses
+            stats = {'requests': len(latencies), 'cache_hits': self.hits, 'cache_misses': self.misses,
+                     'hit_rate': self.hits / n if n else None,
+                     'cached_patients': len(self.cache), 'cached_mb': self.cached_bytes / 1e6,
+                     'cache_mb': self.cache_bytes / 1e6}
+
+        for p in [50, 90, 99, 99.9]:
+            stats['p{}_ms'.format(p)] = float(np.percentile(latencies, p)) if len(latencies) else None
+        return stats
+
+    def record(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def close(self):
+        self.file.close()
+
+    def _insert(self, patient_id, timeline, size):
+        '''
+        Add a timeline to the cache and evict the least recently used timelines
+        '''
+
+        if size > self.cache_bytes or patient_id in self.cache:
+            return
+
+        self.cache[patient_id] = (timeline, size)
+        self.cached_bytes += size
+
+        while self.cached_bytes > self.cache_bytes:
+            _, (_, old_size) = self.cache.popitem(last=False)
+            self.cached_bytes -= old_size
+
+
+def _decode(patient_id, block):
+    '''
+    Decode the block of a patient in the tuple file
+    '''
+
+    timeline = {'patient_id': patient_id, 'admission_id': [], 'time': [], 'code': [], 'value': []}
+    for line in block.decode('utf8').split('\n')[:-1]:
+        _, admission_id, time, code, value = line.split(',', 4)
+        timeline['admission_id'].append(admission_id)
+        timeline['time'].append(time)
+        timeline['code'].append(code)
+        timeline['value'].append(value)
+    return timeline
+
+
+def _timeline_size(timeline):
+    '''
+    Bytes of memory of a decoded timeline (the dict, its lists and their strings)
+    '''
+
+    size = sys.getsizeof(timeline)
+    for key, column in timeline.items():
+        size += sys.getsizeof(key) + sys.getsizeof(column)
+        if isinstance(column, list):
+            size += sum(map(sys.getsizeof, column))
+    return size
+
+
+def _load_admissions():
+    '''
+    The patient of each admission (from admissions_dict.csv if it exists, or core/admissions.csv)
+    '''
+
+    path = RESULT_ROOT_DIR + 'admissions_dict.csv'
+    if not os.path.exists(path):
+        path = MIMIC_DIR + 'core/admissions.csv'
+
+    admissions = pd.read_csv(path, usecols=['subject_id', 'hadm_id'], dtype=str, index_col=False)
+    return dict(zip(admissions['hadm_id'], admissions['subject_id'].astype(np.int64).tolist()))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    '''
+    HTTP requests of the timeline server (the store is an attribute of the server)
+    '''
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        self._answer(url.path, lambda name:params[name][0])
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        self._answer(url.path, lambda name:self._body_ids())
+
+    def _body_ids(self):
+        '''
+        The IDs in the body of a POST request (a JSON list), comma-separated
+        '''
+
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'[]')
+        if not isinstance(body, list):
+            raise ValueError('the body is not a JSON list of IDs')
+        return ','.join(str(i) for i in body)
+
+    def _answer(self, path, param):
+        start = time.perf_counter()
+        store = self.server.store
+        try:
+            if path == '/timeline':
+                result = store.timelines([param('patient_id')])[0]
+            elif path == '/timelines':
+                result = store.timelines(param('patient_id').split(','))
+            elif path == '/admission':
+                result = store.admission(param('admission_id'))
+            elif path == '/stats':
+                result = store.stats()
+            else:
+                self.send_error(404, 'unknown request {}'.format(path))
+                return
+        except (KeyError, ValueError) as e:
+            self.send_error(400, 'bad request: {}'.format(e))
+            return
+
+        data = json.dumps(result).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+        if path != '/stats':
+            store.record(time.perf_counter() - start)
+
+    def address_string(self):
+        # the client address of a UNIX socket is empty
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def serve(store, port=8765, socket_path=None):
+    '''
+    Serve the timelines of a store over localhost HTTP, or over a UNIX socket if socket_path is given
+    (until interrupted).
+    '''
+
+    if socket_path is not None:
+        server = _UnixHTTPServer(socket_path, _Handler)
+        print('Serving timelines on', socket_path)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        print('Serving timelines on http://127.0.0.1:{}'.format(port))
+
+    server.store = store
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
+        print(json.dumps(store.stats()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve patient timelines of tuples.csv.')
+    parser.add_argument('--tuple_path', default=RESULT_ROOT_DIR + 'tuples.csv', help='tuple file (with its index)')
+    parser.add_argument('--port', type=int, default=8765, help='port on 127.0.0.1')
+    parser.add_argument('--socket', default=None, help='serve over this UNIX socket instead of TCP')
+    parser.add_argument('--cache_mb', type=float, default=1024, help='size of the cache (MB of decoded timelines)')
+    args = parser.parse_args()
+
+    serve(TimelineStore(args.tuple_path, int(args.cache_mb * 1e6)), args.port, args.socket)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,160 @@
+import sys
+import queue
+import threading
+import numpy as np
+from settings import RESULT_ROOT_DIR, TIME_ENCODING
+import tuple_codec
+import tuple_index
+import columnar_store
+import stream_io
+
+
+'''
+Streaming access to the timelines of patients in tuples.csv.
+
+The tuples of a batch of patients are read with the per-patient index
+(see tuple_index) by a background thread, while the caller processes the
+previous batches. At most `readahead` batches are held in memory, so the
+memory does not depend on the size of the dataset.
+
+Example:
+    for batch in iter_timelines(RESULT_ROOT_DIR + 'tuples.csv', batch_size=512):
+        for i, patient_id in enumerate(batch['patient_id']):
+            rows = slice(batch['row_splits'][i], batch['row_splits'][i + 1])
+            codes, values = batch['code'][rows], batch['value'][rows]
+'''
+
+
+def iter_timelines(tuple_path=RESULT_ROOT_DIR + 'tuples.csv', dict_path=None, patients=None,
+                   batch_size=1000, readahead=2, value_ids=False):
+    '''
+    Iterate over the timelines of patients, a batch of patients at a time.
+
+    Parameters:
+    ----
+        tuple_path:
+            filepath of tuples.csv (or string_tuples.csv), which must have its index (see tuple_index)
+        dict_path:
+            filepath of code_dict.csv; if given, codes are returned as the integer index of the dictionary
+        patients:
+            IDs of the patients to read (default: all patients), in any order
+        batch_size:
+            number of patients in a batch
+        readahead:
+            number of batches read in advance by the background thread
+        value_ids:
+            whether the values are value IDs (string_tuples.csv), see tuple_codec.load_value_vocab
+
+    Returns:
+    ----
+        A generator of batches in the order of patient IDs. A batch is a dictionary of numpy arrays:
+            patient_id:     int64, the patients of the batch
+            row_splits:     int64, the tuples of the i-th patient are rows row_splits[i]:row_splits[i+1]
+            admission_id:   str (object), empty if the tuple has no admission
+            time:           int64 seconds since 1970-01-01 (INT64_MIN if NaT), or the time offset
+                            if the tuples have relative time (see columnar_store.encode_time)
+            code:           str (object), or int32 if dict_path is given
+            value:          float32 value or sentinel code, NaN if empty or kept as text (see tuple_codec),
+                            or int64 value ID if value_ids is True
+            value_text:     str (object), the values which are not restored by float32 (not with value_ids)
+    '''
+
+    index = tuple_index.load_index(tuple_path)
+    code2idx = tuple_codec.load_code_index(dict_path) if dict_path is not None else None
+
+    selected = np.ones(index.shape[0], dtype=bool)
+    if patients is not None:
+        selected = np.isin(index['patient_id'], np.asarray(list(patients), dtype=np.int64))
+    patient_ids = np.asarray(index['patient_id'][selected])
+    counts = np.asarray(index['count'][selected])
+
+    batches = queue.Queue(max(1, readahead))
+    stop = threading.Event()
+
+    def read():
+        try:
+            with stream_io.open_reader(tuple_path) as f:
+                for start in range(0, patient_ids.shape[0], batch_size):
+                    ids = patient_ids[start:start + batch_size]
+                    table = tuple_index.read_patients(f, index, ids, keep_default_na=False)
+                    batch = _to_arrays(table, ids, counts[start:start + batch_size], code2idx, value_ids)
+                    if not _put(batches, batch, stop):
+                        return
+        except Exception as e:
+            _put(batches, e, stop)
+            return
+        _put(batches, None, stop)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        # the caller may stop early: let the reader thread exit
+        stop.set()
+        reader.join()
+
+
+def _put(batches, item, stop):
+    '''
+    Put an item into the queue unless the iteration is stopped. Return False if stopped.
+    '''
+
+    while not stop.is_set():
+        try:
+            batches.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _to_arrays(table, patient_ids, counts, code2idx=None, value_ids=False):
+    '''
+    Convert the tuples of a batch of patients to numpy arrays
+    '''
+
+    if table.shape[0] != counts.sum():
+        raise ValueError('the index does not match the tuple file (expected {} rows, found {})'.format(
+            counts.sum(), table.shape[0]))
+
+    batch = {}
+    batch['patient_id'] = np.asarray(patient_ids, dtype=np.int64)
+    batch['row_splits'] = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    batch['admission_id'] = table['admission_id'].values.astype(object)
+    batch['time'] = columnar_store.encode_time(table['time'], TIME_ENCODING is not None)
+
+    if code2idx is not None:
+        code = table['code'].map(code2idx)
+        if code.isna().any():
+            raise ValueError('unknown codes: {}'.format(table.loc[code.isna(), 'code'].unique()))
+        batch['code'] = code.values.astype(np.int32)
+    else:
+        batch['code'] = table['code'].values.astype(object)
+
+    if value_ids:
+        batch['value'] = table['value'].values.astype(np.int64)
+    else:
+        batch['value'], batch['value_text'] = tuple_codec.encode_values(table['value'])
+        batch['value_text'] = batch['value_text'].astype(object)
+    return batch
+
+
+def main():
+    n_patients = 0
+    n_tuples = 0
+    for batch in iter_timelines(RESULT_ROOT_DIR + 'tuples.csv'):
+        n_patients += batch['patient_id'].shape[0]
+        n_tuples += batch['row_splits'][-1]
+    print('patients:', n_patients, 'tuples:', n_tuples)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,270 @@
+import sys
+import os
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from settings import RESULT_ROOT_DIR
+import stream_io
+
+
+'''
+Integer-coded tuples: the code column holds the index of code_dict.csv
+and the value column holds a float32 (or a sentinel code).
+'''
+
+
+# sentinel codes of the value column (out of the range of any lab/chart value)
+SENTINELS = {
+    '_MISSING': np.float32(-3.0e38),
+    '_STRING': np.float32(-3.1e38),
+    '_EMPTY': np.float32(-3.2e38),
+}
+
+cols = ['patient_id', 'admission_id', 'time', 'code', 'value']
+coded_cols = cols + ['value_text']
+
+
+def load_code_index(dict_path):
+    '''
+    Load the mapping between code tokens (e.g. "mimic_51484") and
+    the integer index of code_dict.csv.
+
+    Parameters:
+    ----
+        dict_path:
+            filepath of code_dict.csv
+
+    Returns:
+    ----
+        A pandas.Series mapping code tokens to indexes
+    '''
+
+    with stream_io.open_reader(dict_path) as f:
+        dic = pd.read_csv(f, usecols=['index', 'code', 'code_type'], dtype={'index':np.int32, 'code':str,
+                          'code_type':str}, keep_default_na=False, index_col=False)
+    return pd.Series(dic['index'].values, index=(dic['code_type'] + '_' + dic['code']).values)
+
+
+def float32_text(values):
+    '''
+    Text form of float32 values used by the coded tuples (str of numpy.float32, e.g. "80.0").
+    Zero is written as "0", the same as in tuples.csv.
+    '''
+
+    # format the distinct values only
+    values, inverse = np.unique(np.asarray(values, dtype=np.float32), return_inverse=True)
+    text = values.astype(str).astype(object)
+    text[values == 0] = '0'
+    return text[inverse.reshape(-1)]
+
+
+def encode_values(values:pd.Series):
+    '''
+    Encode the value column of tuples as float32.
+    A number is kept as float32 only if its float32 text (see float32_text) is the same
+    as its text in the tuples, so that decode_values restores the text exactly.
+
+    Parameters:
+    ----
+        values:
+            the value column (str) of tuples
+
+    Returns:
+    ----
+        value:
+            float32 array, NaN if the value is empty or kept as text
+        value_text:
+            str array, values that cannot be restored from float32 exactly
+    '''
+
+    values = values.fillna('').astype(str)
+    value = np.full(values.shape[0], np.nan, dtype=np.float32)
+
+    is_sentinel = values.isin(SENTINELS).values
+    value[is_sentinel] = values[is_sentinel].map(SENTINELS).values
+
+    # numbers are kept only if their text is restored from the float32,
+    # which is checked once for each distinct text
+    candidate = ~is_sentinel & (values != '').values
+    codes, texts = pd.factorize(values[candidate])
+    texts = np.asarray(texts, dtype=object)
+    with np.errstate(over='ignore', invalid='ignore'):
+        num32 = np.asarray(pd.to_numeric(texts, errors='coerce'), dtype=np.float64).astype(np.float32)
+    valid = ~np.isnan(num32) & ~np.isin(num32, list(SENTINELS.values()))
+    restored = np.full(texts.shape[0], None, dtype=object)
+    restored[valid] = float32_text(num32[valid])
+
+    exact = (restored == texts)[codes]
+    value[np.flatnonzero(candidate)[exact]] = num32[codes[exact]]
+
+    value_text = np.where(np.isnan(value), values.values, '')
+    return value, value_text
+
+
+def decode_values(value, value_text):
+    '''
+    Decode float32 values (and their text) back to the value column of tuples.csv.
+
+    Parameters:
+    ----
+        value:
+            float32 array, NaN if the value is empty or kept as text
+        value_text:
+            str array of values kept as text
+
+    Returns:
+    ----
+        the value column (str array)
+    '''
+
+    value = np.asarray(value, dtype=np.float32)
+    out = np.asarray(value_text, dtype=object).copy()
+
+    is_num = ~np.isnan(value)
+    for k, v in SENTINELS.items():
+        is_sentinel = value == v
+        out[is_sentinel] = k
+        is_num &= ~is_sentinel
+
+    out[is_num] = float32_text(value[is_num])
+    return out
+
+
+def encode_tuples(tuple_path, dict_path, out_path, chunksize=30000000):
+    '''
+    Convert tuples.csv to integer-coded tuples.
+    Each chunk is checked to decode back to the same values (ValueError otherwise).
+
+    Parameters:
+    ----
+        tuple_path:
+            filepath of tuples.csv
+        dict_path:
+            filepath of code_dict.csv
+        out_path:
+            filepath to output the integer-coded tuples
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('Encoding {} as integer-coded tuples...'.format(tuple_path))
+
+    code2idx = load_code_index(dict_path)
+
+    # the header is written even if there is no tuple
+    pd.DataFrame(columns=coded_cols).to_csv(out_path, index=False)
+
+    with stream_io.open_reader(tuple_path) as f, pd.read_csv(f, index_col=False, chunksize=chunksize,
+            dtype='str', keep_default_na=False, quoting=3) as reader:
+        for chunk in tqdm(reader):
+            code = chunk['code'].map(code2idx)
+            if code.isna().any():
+                raise ValueError('codes not in {}: {}'.format(dict_path, chunk.loc[code.isna(), 'code'].unique().tolist()))
+
+            value, value_text = encode_values(chunk['value'])
+            mismatch = decode_values(value, value_text) != chunk['value'].values
+            if mismatch.any():
+                raise ValueError('values not restored by the coded tuples: {}'.format(
+                    chunk.loc[mismatch, 'value'].unique()[:10].tolist()))
+
+            chunk['code'] = code.astype(np.int32).values
+            chunk['value'] = np.where(np.isnan(value), '', float32_text(value))
+            chunk['value_text'] = value_text
+
+            chunk.to_csv(out_path, columns=coded_cols, index=False, header=False, mode='a')
+
+
+def read_coded_tuples(coded_path, **kwargs):
+    '''
+    Read integer-coded tuples with proper dtypes.
+    Keyword arguments are passed to pandas.read_csv (e.g. chunksize).
+    '''
+
+    setting = {'patient_id':str, 'admission_id':str, 'time':str, 'code':np.int32,
+               'value':np.float32, 'value_text':str}
+    return pd.read_csv(coded_path, index_col=False, dtype=setting, na_values={'value':['']},
+                       keep_default_na=False, **kwargs)
+
+
+def load_value_vocab(vocab_path):
+    '''
+    Load the vocabulary of string values (string_value_vocab.csv).
+
+    Parameters:
+    ----
+        vocab_path:
+            filepath of string_value_vocab.csv
+
+    Returns:
+    ----
+        A pandas.Series mapping value IDs to texts
+    '''
+
+    vocab = pd.read_csv(vocab_path, usecols=['value_id', 'value'], dtype={'value_id':np.int64, 'value':str},
+                        keep_default_na=False, index_col=False)
+    return pd.Series(vocab['value'].values, index=vocab['value_id'].values)
+
+
+def decode_string_values(values, vocab):
+    '''
+    Decode the value column (value IDs) of string_tuples.csv to texts.
+
+    Parameters:
+    ----
+        values:
+            the value column of string_tuples.csv
+        vocab:
+            the vocabulary returned by load_value_vocab
+
+    Returns:
+    ----
+        the texts (str array)
+    '''
+
+    ids = np.asarray(values).astype(np.int64)
+    return vocab.reindex(ids).values
+
+
+def decode_tuples(coded_path, dict_path, out_path, chunksize=30000000):
+    '''
+    Convert integer-coded tuples back to the text form of tuples.csv.
+
+    Parameters:
+    ----
+        coded_path:
+            filepath of the integer-coded tuples
+        dict_path:
+            filepath of code_dict.csv
+        out_path:
+            filepath to output tuples.csv
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('Decoding {}...'.format(coded_path))
+
+    code2idx = load_code_index(dict_path)
+    idx2code = pd.Series(code2idx.index, index=code2idx.values)
+
+    with open(out_path, 'w', encoding='utf8') as f:
+        f.write(','.join(cols) + '\n')
+        with read_coded_tuples(coded_path, chunksize=chunksize) as reader:
+            for chunk in tqdm(reader):
+                code = chunk['code'].map(idx2code)
+                value = decode_values(chunk['value'].values, chunk['value_text'].values)
+                lines = chunk['patient_id'] + ',' + chunk['admission_id'] + ',' + chunk['time'] + ',' + \
+                    code + ',' + value + '\n'
+                f.write(''.join(lines))
+
+
+def main():
+    encode_tuples(RESULT_ROOT_DIR + 'tuples.csv', RESULT_ROOT_DIR + 'code_dict.csv',
+                  RESULT_ROOT_DIR + 'tuples_int.csv')
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,196 @@
+import sys
+import os
+import io
+import numpy as np
+import pandas as pd
+from settings import RESULT_ROOT_DIR
+
+
+'''
+Per-patient byte-offset index of tuples.csv / string_tuples.csv.
+
+merge_tuples writes the tuples of each patient contiguously, and records
+the byte offset, the byte length and the number of rows of each patient
+in <name>_index.npy.
+'''
+
+
+INDEX_DTYPE = [('patient_id', np.int64), ('offset', np.int64), ('length', np.int64), ('count', np.int64)]
+
+cols = ['patient_id', 'admission_id', 'time', 'code', 'value']
+
+
+def index_path(tuple_path):
+    '''
+    filepath of the index of a tuple file (e.g. tuples.csv -> tuples_index.npy)
+    '''
+
+    return os.path.splitext(tuple_path)[0] + '_index.npy'
+
+
+def save_index(index, tuple_path):
+    '''
+    Output the index of a tuple file.
+
+    Parameters:
+    ----
+        index:
+            list of (patient_id, offset, length, count), in the order of the file
+        tuple_path:
+            filepath of the tuple file
+
+    Returns:
+    ----
+        No return
+    '''
+
+    np.save(index_path(tuple_path), np.array(index, dtype=INDEX_DTYPE))
+
+
+def load_index(tuple_path):
+    '''
+    Load (memory-map) the index of a tuple file.
+    '''
+
+    return np.load(index_path(tuple_path), mmap_mode='r')
+
+
+def _find(index, patient_ids):
+    '''
+    Find the rows of patients in the index (-1 if not found)
+    '''
+
+    patient_ids = np.asarray(patient_ids, dtype=np.int64)
+    i = np.searchsorted(index['patient_id'], patient_ids)
+    i[i >= index.shape[0]] = 0
+    found = index['patient_id'][i] == patient_ids if index.shape[0] else np.zeros(i.shape[0], dtype=bool)
+    return np.where(found, i, -1)
+
+
+def _parse(data, **kwargs):
+    '''
+    Parse lines of a tuple file
+    '''
+
+    if len(data) == 0:
+        return pd.DataFrame({i:pd.Series(dtype=object) for i in cols})
+
+    return pd.read_csv(io.BytesIO(data), header=None, names=cols, index_col=False, dtype='str', quoting=3, **kwargs)
+
+
+def read_patient(f, index, patient_id, **kwargs):
+    '''
+    Read the tuples of a patient.
+
+    Parameters:
+    ----
+        f:
+            the tuple file opened in binary mode
+        index:
+            the index of the file (see load_index)
+        patient_id:
+            ID of the patient
+        kwargs:
+            passed to pandas.read_csv (e.g. keep_default_na=False)
+
+    Returns:
+    ----
+        A table of tuples (empty if the patient has no tuple)
+    '''
+
+    return read_patients(f, index, [patient_id], **kwargs)
+
+
+def read_patients(f, index, patient_ids, **kwargs):
+    '''
+    Read the tuples of many patients with one sequential pass:
+    the blocks are read in the order of their offsets, and adjacent
+    blocks are read with a single I/O.
+
+    Parameters:
+    ----
+        f:
+            the tuple file opened in binary mode (see stream_io.open_reader;
+            seeking in a compressed file is slow)
+        index:
+            the index of the file (see load_index)
+        patient_ids:
+            IDs of the patients
+        kwargs:
+            passed to pandas.read_csv (e.g. keep_default_na=False)
+
+    Returns:
+    ----
+        A table of tuples, ordered by patient ID (patients without tuples are ignored)
+    '''
+
+    rows = _find(index, np.unique(np.asarray(patient_ids, dtype=np.int64)))
+    rows = rows[rows >= 0]
+
+    data = []
+    for start, end in _block_ranges(index, rows):
+        f.seek(start)
+        data.append(f.read(end - start))
+
+    return _parse(b''.join(data), **kwargs)
+
+
+def iter_patient_blocks(f, index, patient_ids, max_size=1 << 26):
+    '''
+    Read the blocks (bytes) of many patients one at a time, with one
+    sequential pass where adjacent blocks are read with a single I/O
+    of at most max_size bytes (unless a block is larger).
+
+    Parameters:
+    ----
+        f:
+            the tuple file opened in binary mode
+        index:
+            the index of the file (see load_index)
+        patient_ids:
+            IDs of the patients
+        max_size:
+            maximum size of a single read
+
+    Returns:
+    ----
+        A generator of (patient ID, bytes of the tuples), ordered by patient ID
+    '''
+
+    rows = _find(index, np.unique(np.asarray(patient_ids, dtype=np.int64)))
+    rows = rows[rows >= 0]
+
+    i = 0
+    for start, end in _block_ranges(index, rows, max_size):
+        f.seek(start)
+        data = f.read(end - start)
+
+        while i < rows.shape[0] and index['offset'][rows[i]] < end:
+            offset = int(index['offset'][rows[i]]) - start
+            yield int(index['patient_id'][rows[i]]), data[offset:offset + int(index['length'][rows[i]])]
+            i += 1
+
+
+def _block_ranges(index, rows, max_size=None):
+    '''
+    Byte ranges [start, end) covering the blocks of sorted index rows,
+    where adjacent blocks are coalesced (into ranges of at most max_size bytes if given).
+    '''
+
+    if len(rows) == 0:
+        return []
+
+    starts = index['offset'][rows]
+    stops = starts + index['length'][rows]
+
+    ranges = []
+    start, end = int(starts[0]), int(stops[0])
+    for s, e in zip(starts[1:], stops[1:]):
+        if s == end and (max_size is None or e - start <= max_size):
+            end = int(e)
+        else:
+            ranges.append((start, end))
+            start, end = int(s), int(e)
+    ranges.append((start, end))
+
+    return ranges
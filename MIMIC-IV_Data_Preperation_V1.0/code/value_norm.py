@@ -0,0 +1,218 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from settings import RESULT_ROOT_DIR
+import tuple_index
+import stream_io
+
+
+'''
+Normalization of the numeric values of tuples, driven by the codes with
+value (with_value = 1) of code_dict.csv.
+
+fit_value_stats computes the mean, the standard deviation and the quantile
+edges of the values of each code, and saves them in value_stats.csv next to
+code_dict.csv, so that the same normalization can be applied again (e.g. to
+a cohort run). normalize_tuples then replaces the numeric values with:
+    zscore:     (value - mean) / std
+    bins:       the quantile bin of the value as a token, "Q1" ... "Q<n_bins>"
+Other values (e.g. _MISSING, _STRING) and codes without value are unchanged.
+
+Example:
+    fit_value_stats(RESULT_ROOT_DIR + 'tuples.csv', RESULT_ROOT_DIR + 'code_dict.csv', n_bins=10)
+    normalize_tuples(RESULT_ROOT_DIR + 'tuples.csv', RESULT_ROOT_DIR + 'value_stats.csv',
+                     RESULT_ROOT_DIR + 'tuples_bins.csv', mode='bins')
+'''
+
+
+MODES = ['zscore', 'bins']
+
+
+def stats_path(dict_path):
+    '''
+    filepath of the value statistics of a dictionary (value_stats.csv in the same directory)
+    '''
+
+    return os.path.join(os.path.dirname(stream_io.strip_ext(dict_path)), 'value_stats.csv')
+
+
+def fit_value_stats(tuple_path, dict_path, n_bins=10, max_samples=20000, seed=0, chunksize=10000000):
+    '''
+    Compute the value statistics of the codes with value with one pass over the tuples.
+    The mean and standard deviation are exact (the per-chunk statistics are combined with the
+    parallel update of Chan et al.); the quantile edges are computed from a random
+    sample of at most about max_samples values of each code (the sampling rate of a code
+    is given by its value_frequency in the dictionary).
+
+    Parameters:
+    ----
+        tuple_path:
+            filepath of tuples.csv
+        dict_path:
+            filepath of code_dict.csv
+        n_bins:
+            number of quantile bins (n_bins - 1 edges)
+        max_samples:
+            number of values of a code used for the quantile edges
+        seed:
+            seed of the sampling
+        chunksize:
+            number of tuples read at a time
+
+    Returns:
+    ----
+        No return
+    '''
+
+    print('Computing the value statistics of', tuple_path)
+
+    with stream_io.open_reader(dict_path) as f:
+        dic = pd.read_csv(f, usecols=['code', 'code_type', 'value_frequency', 'with_value'],
+                          dtype={'code':str, 'code_type':str}, keep_default_na=False, index_col=False)
+    dic = dic.loc[dic['with_value'] == 1, :]
+    tokens = (dic['code_type'] + '_' + dic['code']).values
+    rates = pd.Series(np.minimum(1, max_samples / dic['value_frequency'].clip(lower=1)).values, index=tokens)
+
+    rng = np.random.default_rng(seed)
+    stats = pd.DataFrame(columns=['count', 'mean', 'm2'], dtype=np.float64)
+    samples = []
+    with stream_io.open_reader(tuple_path) as f, pd.read_csv(f, usecols=['code', 'value'], dtype=str,
+            keep_default_na=False, index_col=False, quoting=3, chunksize=chunksize) as reader:
+        for chunk in tqdm(reader):
+            values = _numeric_values(chunk, rates.index)
+            part = values.groupby('code')['value'].agg(count='size', mean='mean')
+            deviation = values['value'] - values['code'].map(part['mean'])
+            part['m2'] = (deviation ** 2).groupby(values['code']).sum()
+            stats = _combine_stats(stats, part)
+
+            sampled = rng.random(values.shape[0]) < values['code'].map(rates).values
+            samples.append(values.loc[sampled, ['code', 'value']])
+
+    stats['std'] = np.sqrt(stats['m2'] / stats['count'])
+    stats['count'] = stats['count'].astype(np.int64)
+
+    # quantile edges of the sampled values
+    edges = ['edge_{}'.format(i) for i in range(1, n_bins)]
+    qs = np.arange(1, n_bins) / n_bins
+    samples = pd.concat(samples) if len(samples) else pd.DataFrame({'code':[], 'value':[]})
+    if len(edges) != 0 and samples.shape[0] != 0:
+        quantiles = samples.groupby('code')['value'].quantile(qs).unstack()
+        quantiles.columns = edges
+        stats = stats.join(quantiles)
+    stats = stats.reindex(columns=['count', 'mean', 'std'] + edges)
+
+    stats.index.name = 'code'
+    stats.to_csv(stats_path(dict_path))
+    print('value statistics of {} codes'.format(stats.shape[0]))
+
+
+def load_value_stats(path):
+    '''
+    Load value_stats.csv, indexed by code token (e.g. "mimic_50912")
+    '''
+
+    return pd.read_csv(path, dtype={'code':str}, keep_default_na=False, na_values=[''], index_col='code')
+
+
+def normalize_tuples(tuple_path, stats_file, out_path, mode='zscore', chunksize=10000000):
+    '''
+    Output the tuples with their numeric values normalized, with one pass over the tuples.
+
+    Parameters:
+    ----
+        tuple_path:
+            filepath of tuples.csv
+        stats_file:
+            filepath of value_stats.csv (see fit_value_stats)
+        out_path:
+            filepath of the output tuples
+        mode:
+            'zscore' or 'bins' (see MODES)
+        chunksize:
+            number of tuples read at a time
+
+    Returns:
+    ----
+        No return
+    '''
+
+    assert mode in MODES, 'unknown mode {}'.format(mode)
+    print('Normalizing the values of {} ({})'.format(tuple_path, mode))
+
+    stats = load_value_stats(stats_file)
+    mean = stats['mean'].values
+    std = stats['std'].values
+    edges = stats.loc[:, [i for i in stats.columns if i.startswith('edge_')]].values
+    # codes without sampled values fall in the first bin
+    edges = np.where(np.isnan(edges), np.inf, edges)
+    code2row = pd.Series(np.arange(stats.shape[0]), index=stats.index)
+
+    with stream_io.open_reader(tuple_path) as f, stream_io.open_writer(out_path, text=True) as out, \
+            pd.read_csv(f, dtype=str, keep_default_na=False, index_col=False, quoting=3,
+                        chunksize=chunksize) as reader:
+        out.write(','.join(tuple_index.cols) + '\n')
+        for chunk in tqdm(reader):
+            row = chunk['code'].map(code2row).values
+            value = pd.to_numeric(chunk['value'], errors='coerce').values
+            selected = ~np.isnan(row) & ~np.isnan(value)
+
+            row = row[selected].astype(np.int64)
+            value = value[selected]
+            if mode == 'zscore':
+                scale = np.where(std[row] > 0, std[row], 1)
+                text = np.char.mod('%.4g', (value - mean[row]) / scale)
+            else:
+                bins = (value[:, None] >= edges[row]).sum(axis=1) + 1
+                text = np.char.add('Q', bins.astype(str))
+
+            chunk.loc[selected, 'value'] = text
+            lines = chunk[tuple_index.cols[0]].str.cat(chunk[tuple_index.cols[1:]], sep=',')
+            out.write('\n'.join(lines) + '\n' if lines.shape[0] else '')
+
+
+def _combine_stats(a, b):
+    '''
+    Combine the (count, mean, m2) of two sets of values per code, where m2 is the
+    sum of squared differences from the mean (Chan et al.), without cancellation
+    '''
+
+    codes = a.index.union(b.index)
+    a = a.reindex(codes, fill_value=0)
+    b = b.reindex(codes, fill_value=0)
+
+    count = a['count'] + b['count']
+    delta = b['mean'] - a['mean']
+    weight = b['count'] / count
+    return pd.DataFrame({'count': count,
+                         'mean': a['mean'] + delta * weight,
+                         'm2': a['m2'] + b['m2'] + delta ** 2 * a['count'] * weight})
+
+
+def _numeric_values(chunk, codes):
+    '''
+    The numeric values of the given codes in a chunk of tuples
+    '''
+
+    value = pd.to_numeric(chunk['value'], errors='coerce')
+    selected = value.notna() & chunk['code'].isin(codes)
+    return pd.DataFrame({'code': chunk['code'][selected].values, 'value': value[selected].values})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Normalize the numeric values of tuples.')
+    parser.add_argument('--mode', choices=MODES, default='zscore', help='normalization of the values')
+    parser.add_argument('--n_bins', type=int, default=10, help='number of quantile bins')
+    parser.add_argument('--reuse_stats', action='store_true', help='use the existing value_stats.csv')
+    args = parser.parse_args()
+
+    dict_path = RESULT_ROOT_DIR + 'code_dict.csv'
+    if not args.reuse_stats:
+        fit_value_stats(RESULT_ROOT_DIR + 'tuples.csv', dict_path, args.n_bins)
+    normalize_tuples(RESULT_ROOT_DIR + 'tuples.csv', stats_path(dict_path),
+                     RESULT_ROOT_DIR + 'tuples_{}.csv'.format(args.mode), args.mode)
+
+
+if __name__=='__main__':
+    main()